@@ -69,6 +69,14 @@ class ActionDSReaderHelper(InterfaceActionBase):
         '''
         config_widget.save_settings()
 
+    def cli_main(self, args):
+        '''
+        calibre-debug -r "DSReader Helper" -- [--library NAME] [--workers N]
+        extracts and indexes the dictionaries without the GUI
+        '''
+        from calibre_plugins.dsreader_helper.preindex import main
+        raise SystemExit(main(args[1:]))    # calibre-debug -r ignores the return value
+
 
 # For testing, run from command line with this:
 # calibre-debug -e __init__.py
@@ -61,7 +61,11 @@ class DSReaderHelperAction(InterfaceAction):
         self.server.start()
         print('server current_thread %s' % str(self.server.current_thread))
 
-        cfg.rebuild_dict_builders()
+        # indexes are built in the background, lookups skip dictionaries not ready yet,
+        # changes to the dictionary library are picked up without a restart
+        from calibre_plugins.dsreader_helper.srv.dict_loader import (dict_loader, dict_watcher)
+        dict_loader.start()
+        dict_watcher.start()
         # result_text = builder.mdx_lookup('dedication')
         # print('mdx result %s' % result_text)
 
@@ -10,6 +10,7 @@ __docformat__ = 'restructuredtext en'
 import six
 from six import text_type as unicode
 import json, os, copy
+import threading
 
 try:
     from PyQt5 import QtCore
@@ -19,13 +20,13 @@ try:
                           QFormLayout, 
                           QLineEdit, QTabWidget, QAbstractItemView,
                           QTableWidget, QHBoxLayout, QSpinBox, QMessageBox, 
-                          QTableView, QAbstractTableModel, QModelIndex)
+                          QTableView, QAbstractTableModel, QModelIndex, QTimer)
 except ImportError:
     from PyQt4 import QtGui, QtCore
     from PyQt4.Qt import (Qt, QWidget, QGridLayout, QLabel, QPushButton, QUrl,
                           QGroupBox, QComboBox, QVBoxLayout, QCheckBox,
                           QLineEdit, QTabWidget,QAbstractItemView,
-                          QTableWidget, QHBoxLayout, QSpinBox)
+                          QTableWidget, QHBoxLayout, QSpinBox, QTimer)
 
 from calibre.utils.config import JSONConfig
 from calibre.srv.opts import server_config
@@ -50,6 +51,29 @@ KEY_READING_POSITION_COLUMN_ALL_LIBRARY = 'readingPositionColumnAllLibrary'
 KEY_DICT_VIEWER_ENABLED = 'dictViewerEnabled'
 KEY_DICT_VIEWER_LIBRARY_NAME = 'dictViewerLibraryName'
 KEY_DICT_VIEWER_ORDERED_LIST = 'dictViewerOrderedList'
+KEY_DICT_VIEWER_LOOKUP_CACHE_SIZE = 'dictViewerLookupCacheSize'
+KEY_DICT_VIEWER_LOOKUP_WORKERS = 'dictViewerLookupWorkers'
+KEY_DICT_VIEWER_LOOKUP_TIMEOUT = 'dictViewerLookupTimeout'
+KEY_DICT_VIEWER_CLIENT_THEME = 'dictViewerClientTheme'
+KEY_DICT_VIEWER_HINT_INDEX = 'dictViewerHintIndex'
+KEY_DICT_VIEWER_HINT_LIMIT = 'dictViewerHintLimit'
+KEY_DICT_VIEWER_BATCH_MAX_SIZE = 'dictViewerBatchMaxSize'
+KEY_DICT_VIEWER_BATCH_MAX_WORDS = 'dictViewerBatchMaxWords'
+KEY_DICT_VIEWER_BATCH_TIMEOUT = 'dictViewerBatchTimeout'
+KEY_DICT_VIEWER_SIMILAR_LIMIT = 'dictViewerSimilarLimit'
+KEY_DICT_VIEWER_SIMILAR_RANKED = 'dictViewerSimilarRanked'
+KEY_DICT_VIEWER_RESOURCE_CACHE_SIZE = 'dictViewerResourceCacheSize'
+KEY_DICT_VIEWER_CSS_CACHE_SIZE = 'dictViewerCssCacheSize'
+KEY_DICT_VIEWER_PREFETCH = 'dictViewerPrefetch'
+KEY_DICT_VIEWER_INLINE_DICTIONARIES = 'dictViewerInlineDictionaries'
+KEY_DICT_VIEWER_INLINE_MAX_SIZE = 'dictViewerInlineMaxSize'
+KEY_DICT_VIEWER_INLINE_CACHE_SIZE = 'dictViewerInlineCacheSize'
+KEY_DICT_VIEWER_LOADING_WAIT = 'dictViewerLoadingWait'
+KEY_DICT_VIEWER_INDEX_WORKERS = 'dictViewerIndexWorkers'
+KEY_DICT_VIEWER_BLOCK_CACHE_SIZE = 'dictViewerBlockCacheSize'
+KEY_DICT_VIEWER_MEMORY_BUDGET = 'dictViewerMemoryBudget'
+KEY_DICT_VIEWER_IDLE_TIME = 'dictViewerIdleTime'
+KEY_DICT_VIEWER_WATCH_INTERVAL = 'dictViewerWatchInterval'
 
 PLUGIN_ICONS = [
                 'images/dsreader.png',
@@ -68,6 +92,29 @@ DEFAULT_STORE_VALUES = {
                         KEY_DICT_VIEWER_ENABLED: False,
                         KEY_DICT_VIEWER_LIBRARY_NAME: 'Dictionary',
                         KEY_DICT_VIEWER_ORDERED_LIST: {},  #library name -> list of dictionaries
+                        KEY_DICT_VIEWER_LOOKUP_CACHE_SIZE: 16,  #MiB of rendered lookup pages
+                        KEY_DICT_VIEWER_LOOKUP_WORKERS: 4,      #0 to query dictionaries one after another
+                        KEY_DICT_VIEWER_LOOKUP_TIMEOUT: 5,      #seconds per dictionary
+                        KEY_DICT_VIEWER_CLIENT_THEME: False,    #theme independent output, colours applied by mdict.js
+                        KEY_DICT_VIEWER_HINT_INDEX: True,       #keep sorted headwords in memory for hint
+                        KEY_DICT_VIEWER_HINT_LIMIT: 50,
+                        KEY_DICT_VIEWER_BATCH_MAX_SIZE: 8,      #MiB of definitions per batch response
+                        KEY_DICT_VIEWER_BATCH_MAX_WORDS: 500,   #words looked up per batch request, the rest are left out
+                        KEY_DICT_VIEWER_BATCH_TIMEOUT: 30,      #seconds per batch request
+                        KEY_DICT_VIEWER_SIMILAR_LIMIT: 10,      #0 to hide similar words
+                        KEY_DICT_VIEWER_SIMILAR_RANKED: False,  #order similar words by edit distance
+                        KEY_DICT_VIEWER_RESOURCE_CACHE_SIZE: 64,    #MiB of mdd resources shared by all dictionaries
+                        KEY_DICT_VIEWER_CSS_CACHE_SIZE: 8,      #MiB of dark theme stylesheets
+                        KEY_DICT_VIEWER_PREFETCH: True,         #load resources of a looked up page before the browser asks
+                        KEY_DICT_VIEWER_INLINE_DICTIONARIES: [],    #dictionaries whose small images and css are put into the page
+                        KEY_DICT_VIEWER_INLINE_MAX_SIZE: 8,     #KiB, larger resources are always linked
+                        KEY_DICT_VIEWER_INLINE_CACHE_SIZE: 8,   #MiB of encoded inline resources
+                        KEY_DICT_VIEWER_LOADING_WAIT: 2,        #seconds a lookup waits for dictionaries still loading
+                        KEY_DICT_VIEWER_INDEX_WORKERS: 4,       #processes building dictionary indexes, 0 to build in calibre
+                        KEY_DICT_VIEWER_BLOCK_CACHE_SIZE: 64,   #MiB of decompressed mdx/mdd record blocks
+                        KEY_DICT_VIEWER_MEMORY_BUDGET: 512,     #MiB for all dictionaries before idle ones are unloaded, 0 to keep all
+                        KEY_DICT_VIEWER_IDLE_TIME: 600,         #seconds without a lookup before a dictionary may be unloaded
+                        KEY_DICT_VIEWER_WATCH_INTERVAL: 30,     #seconds between checks of the dictionary library for changes, 0 to not check
                     }
 
 # This is where all preferences for this plugin will be stored
@@ -76,6 +123,83 @@ plugin_prefs.defaults[STORE_NAME] = DEFAULT_STORE_VALUES
 
 dict_builders = {}
 
+class DictRegistry(object):
+    '''
+    Immutable snapshot of the loaded dictionaries. rebuild_dict_builders
+    builds a complete new one and publish_dict_registry swaps it in, request
+    handlers read cfg.dict_registry once per request.
+    '''
+    def __init__(self, generation=0, builders={}, entries=(), dict_library_name=None, dict_ordered_list=()):
+        self.generation = generation
+        self.builders = builders    #'id#mdx' -> {'id', 'title', 'basepath', 'basename', 'source', 'version', 'builder'}
+        self.entries = entries      #ordered tuple of (quoted name, title, builder, name)
+        self.dict_library_name = dict_library_name
+        self.dict_ordered_list = dict_ordered_list  #as published, including dictionaries not saved in the settings yet
+
+    def get(self, dicname):
+        return self.builders.get(dicname, None)
+
+dict_registry = DictRegistry()
+_dict_registry_lock = threading.Lock()
+
+def dict_entry_name(dict_entry):
+    return '%d#%s' % (dict_entry['id'], dict_entry['mdx'])
+
+def merged_dict_ordered_list(dict_ordered_list, found_list):
+    '''
+    dict_ordered_list followed by the dictionaries of found_list it lacks,
+    so dictionaries found by a rebuild are kept until the order is saved
+    '''
+    names = set(dict_entry_name(d) for d in dict_ordered_list)
+    return list(dict_ordered_list) + [d for d in found_list if dict_entry_name(d) not in names]
+
+def publish_dict_registry(builders=None, dict_ordered_list=None, dict_library_name=None):
+    global dict_builders, dict_registry
+    from calibre_plugins.dsreader_helper.srv.dict_cache import discard_dictionary, lookup_cache
+    from calibre_plugins.dsreader_helper.srv.dict_index import release_indexes
+    from calibre_plugins.dsreader_helper.srv.dict_blocks import install_block_cache
+    from urllib.parse import quote
+
+    with _dict_registry_lock:
+        replaced = builders is not None and builders is not dict_registry.builders
+        if builders is None:
+            builders = dict_registry.builders
+        dropped = list(dict_registry.builders.values()) if replaced else []
+        # builders no longer published under their name, cached data read from them is stale
+        stale = [(dicname, info['builder']) for dicname, info in dict_registry.builders.items()
+                 if info.get('builder', None) and builders.get(dicname, {}).get('builder', None) is not info['builder']]
+        if dict_library_name is None:
+            dict_library_name = dict_registry.dict_library_name
+        if dict_ordered_list is None:
+            c = plugin_prefs[STORE_NAME]
+            prefs_library_name = c.get(KEY_DICT_VIEWER_LIBRARY_NAME, '')
+            dict_ordered_list = c.get(KEY_DICT_VIEWER_ORDERED_LIST, {}).get(prefs_library_name, [])
+            if prefs_library_name == dict_library_name:
+                dict_ordered_list = merged_dict_ordered_list(dict_ordered_list, dict_registry.dict_ordered_list)
+        entries = []
+        for dict_entry in dict_ordered_list:
+            dicname = dict_entry_name(dict_entry)
+            info = builders.get(dicname, None)
+            if info and info.get('builder', None):
+                install_block_cache(info['builder'])
+                entries.append((quote(dicname), info['title'], info['builder'], dicname))
+        registry = DictRegistry(dict_registry.generation + 1, builders, tuple(entries), dict_library_name, tuple(dict_ordered_list))
+        dict_builders = builders
+        dict_registry = registry
+
+    lookup_cache().clear()     # keyed by generation, none of them is asked for again
+    for dicname, builder in stale:
+        discard_dictionary(dicname, builder.owns_file)
+    if replaced:    # builders taken over by an incremental rebuild keep their index
+        release_indexes(info['builder'] for info in builders.values() if info.get('builder', None))
+        # zips of the dropped builders are unmapped, reads still under way return None
+        kept = set(id(info['zip']) for info in builders.values() if info.get('zip', None))
+        for info in dropped:
+            if info.get('zip', None) and id(info['zip']) not in kept:
+                info['zip'].close()
+    print('publish_dict_registry generation %d entries %d' % (registry.generation, len(registry.entries)))
+    return registry
+
 def get_library_reading_position_options(db):
     return db.prefs.get_namespaced(PREFS_NAMESPACE, PREFS_KEY_READING_POSITION_OPTIONS, {
         KEY_READING_POSITION_COLUMN_NAME: DEFAULT_STORE_VALUES[KEY_READING_POSITION_COLUMN_NAME],
@@ -117,7 +241,7 @@ class ConfigWidget(QWidget):
         tab_widget.addTab(self.dict_viewer_tab, _('Dictionary'))
 
     def save_settings(self):
-        new_prefs = {}
+        new_prefs = dict(plugin_prefs[STORE_NAME])    #keep options without widgets
         new_prefs[KEY_SERVICE_PORT] = self.service_tab.port_spinbox.value()
         new_prefs[KEY_GOODREADS_SYNC_ENABLED] = self.service_tab.goodreads_sync_enabled_checkbox.isChecked()
         new_prefs[KEY_READING_POSITION_COLUMN_NAME] = self.service_tab.position_column_name_ledit.text()
@@ -130,6 +254,7 @@ class ConfigWidget(QWidget):
         new_prefs[KEY_DICT_VIEWER_ORDERED_LIST] = self.dict_viewer_tab.library_dict_ordered_list
 
         plugin_prefs[STORE_NAME] = new_prefs
+        publish_dict_registry()     #pick up the new dictionary order
 
 class ServiceTab(QWidget):
 
@@ -369,6 +494,9 @@ class DictViewerTab(QWidget):
         self.dictionary_viewer_library_refresh.clicked.connect(self.refresh_dictionary_list)
         dictionary_column_box_layout.addWidget(self.dictionary_viewer_library_refresh, 1, 2, 1, 1)
 
+        self.dictionary_viewer_loading_label = QLabel('', self)
+        dictionary_column_box_layout.addWidget(self.dictionary_viewer_loading_label, 2, 0, 1, 3)
+
         table_hbox = QGroupBox(_('Dictionary List'), self)
         table_hbox_layout = QHBoxLayout()
         table_hbox.setLayout(table_hbox_layout)
@@ -414,17 +542,48 @@ class DictViewerTab(QWidget):
         self.dict_info_form_name = QLabel(_(''), self)
         dict_info_form_layout.addRow(_('Name:'), self.dict_info_form_name)
 
-        self.refresh_dictionary_list()
+        # the list as last saved and what the last rebuild found, the
+        # Refresh button has the loader rescan the library
+        self.show_dictionary_list()
 
-    def refresh_dictionary_list(self):
-        print('refresh_dictionary_list')
-        
+        self.loading_timer = QTimer(self)
+        self.loading_timer.timeout.connect(self.update_loading)
+        self.update_loading()
+
+    def show_dictionary_list(self):
         dic_library_name = self.dictionary_viewer_library_combobox.selected_value()
-        dict_ordered_list = rebuild_dict_builders(dic_library_name)
+        dict_ordered_list = self.library_dict_ordered_list.get(dic_library_name, [])
+        registry = dict_registry
+        if registry.dict_library_name == dic_library_name:
+            dict_ordered_list = merged_dict_ordered_list(dict_ordered_list, registry.dict_ordered_list)
         self.library_dict_ordered_list[dic_library_name] = dict_ordered_list
 
         self.dict_table_model = DictViewerTableModel(dict_ordered_list)
         self.dict_table_view.setModel(self.dict_table_model)
+        self.dict_table_view.selectionModel().selectionChanged.connect(self.dict_table_selection_changed)
+
+    def update_loading(self):
+        from calibre_plugins.dsreader_helper.srv.dict_loader import dict_loader
+        info = dict_loader.info()
+        if info['running']:
+            self.dictionary_viewer_loading_label.setText(_('Loading dictionaries: %d of %d ready') % (
+                info['counts'].get(DICT_STATE_READY, 0), len(info['dictionaries'])))
+            if not self.loading_timer.isActive():
+                self.loading_timer.start(500)
+            return
+        if self.loading_timer.isActive():
+            self.loading_timer.stop()
+            self.dictionary_viewer_loading_label.setText('')
+            self.show_dictionary_list()
+
+    def refresh_dictionary_list(self):
+        print('refresh_dictionary_list')
+
+        # rebuilt on the loader thread, the list is shown again once it is done
+        from calibre_plugins.dsreader_helper.srv.dict_loader import dict_loader
+        dic_library_name = self.dictionary_viewer_library_combobox.selected_value()
+        dict_loader.start(dic_library_name)
+        self.update_loading()
 
     def dict_table_selection_changed(self, selected, deselected):
         print('dict_table_selection_changed %s %s' % (str(selected), str(deselected)))
@@ -495,23 +654,43 @@ class DictViewerTableModel(QAbstractTableModel):
             if column == 2:
                 return dict_entry['mdx']
 
-def unzip(src_path, dst_dir, pwd=None):
+def unzip(src_path, dst_dir, pwd=None, pattern=None):
     import zipfile
+    import fnmatch
     with zipfile.ZipFile(src_path) as zf:
         members = zf.namelist()
+        if pattern:
+            members = fnmatch.filter(members, pattern)
         for member in members:
             arch_info = zf.getinfo(member)
             arch_name = arch_info.filename.replace('/', os.path.sep)
             dst_path = os.path.join(dst_dir, arch_name)
             dst_path = os.path.normpath(dst_path)
             # print('unzip dst_path %s' % dst_path)
-            if not os.path.exists(dst_path):
+            # a file cut short by an interrupted extraction is extracted again
+            if not os.path.isfile(dst_path) or os.path.getsize(dst_path) != arch_info.file_size:
                 p = zf.extract(arch_info, dst_dir, pwd)
                 # print('unzip %s' % p)
 
-def rebuild_dict_builders(dict_library_name=None):
+DICT_STATE_PENDING = 'pending'
+DICT_STATE_INDEXING = 'indexing'
+DICT_STATE_READY = 'ready'
+DICT_STATE_FAILED = 'failed'
+
+_dict_rebuild_lock = threading.Lock()
+
+def rebuild_dict_builders(dict_library_name=None, progress=None, index_workers=None):
+    '''
+    progress, if given, is called as progress(dicname, state, title, error=None)
+    whenever a dictionary changes to one of the DICT_STATE_* states.
+    index_workers overrides KEY_DICT_VIEWER_INDEX_WORKERS.
+    '''
+    with _dict_rebuild_lock:
+        return _rebuild_dict_builders(dict_library_name, progress or (lambda *args: None), index_workers)
+
+def _rebuild_dict_builders(dict_library_name, progress, index_workers):
     c = plugin_prefs[STORE_NAME]
-    dict_builders.clear()
+    builders = {}
     if not dict_library_name:
         dict_library_name = c.get(KEY_DICT_VIEWER_LIBRARY_NAME, '')
 
@@ -520,6 +699,7 @@ def rebuild_dict_builders(dict_library_name=None):
     import os
     gui_libraries = {os.path.basename(l):l for l in library_paths}
     if dict_library_name not in gui_libraries:
+        publish_dict_registry({}, [], dict_library_name)
         return []
 
     dic_library_path = gui_libraries[dict_library_name]
@@ -535,28 +715,38 @@ def rebuild_dict_builders(dict_library_name=None):
         if 'zipped' not in dict_entry:
             dict_entry['zipped'] = True
 
+    from calibre.constants import cache_dir
+    dic_cache_dir = os.path.join(cache_dir(), 'dsreader_helper_dictionaries')
+    from calibre_plugins.dsreader_helper.srv.dict_manifest import DictManifest
+    manifest = DictManifest(dic_cache_dir)
+
     # 
     import fnmatch
     import zipfile
+    sources = set()
     for book_id in dic_library_all_ids:
         formats = dic_library.get_field(book_id, 'formats', index_is_id=True)
         print('dic formats %s' % str(formats))
         if 'ZIP' in formats:
             dicbook_title = dic_library.get_field(book_id, 'title', index_is_id=True)
             dicbook_fmt_path = dic_library.format_abspath(book_id, 'ZIP', index_is_id=True)
-            
-            with zipfile.ZipFile(dicbook_fmt_path) as zf:
-                members = zf.namelist()
-                mdx_files = fnmatch.filter(members, '*.[mM][dD][xX]')
-                for mdx_file in mdx_files:
-                    print('refresh_dictionary_list title %s %s' % (dicbook_title, mdx_file))
-                    dict_entry = {'id': book_id, 'mdx': mdx_file, 'title': dicbook_title, 'zipped': True}
-                    if dict_entry not in dict_ordered_list:
-                        dict_ordered_list.append(dict_entry)
+            sources.add(dicbook_fmt_path)
+
+            record, changed, known = manifest.check(dicbook_fmt_path)
+            if changed or 'mdx_files' not in record:
+                with zipfile.ZipFile(dicbook_fmt_path) as zf:
+                    members = zf.namelist()
+                    record['mdx_files'] = fnmatch.filter(members, '*.[mM][dD][xX]')
+            for mdx_file in record['mdx_files']:
+                print('refresh_dictionary_list title %s %s' % (dicbook_title, mdx_file))
+                dict_entry = {'id': book_id, 'mdx': mdx_file, 'title': dicbook_title, 'zipped': True}
+                if dict_entry not in dict_ordered_list:
+                    dict_ordered_list.append(dict_entry)
         
         if 'MDX' in formats:
             dicbook_title = dic_library.get_field(book_id, 'title', index_is_id=True)
             dicbook_fmt_path = dic_library.format_abspath(book_id, 'MDX', index_is_id=True)
+            sources.add(dicbook_fmt_path)
             print('refresh_dictionary_list title %s %s' % (dicbook_title, dicbook_fmt_path))
             dict_entry = {'id': book_id, 'mdx': dicbook_fmt_path, 'title': dicbook_title, 'zipped': False}
             if dict_entry not in dict_ordered_list:
@@ -564,48 +754,236 @@ def rebuild_dict_builders(dict_library_name=None):
 
     print('refresh_dictionary_list result %s' % str(dict_ordered_list))
 
-    from calibre.constants import cache_dir
-    dic_cache_dir = os.path.join(cache_dir(), 'dsreader_helper_dictionaries')
     import os, sys
     sys.path.append(os.path.dirname(__file__) + '/mdict_query')
     from calibre_plugins.dsreader_helper.mdict_query import mdict_query
 
+    # builders of unchanged dictionaries are taken over from the published registry,
+    # every newly built one is published right away so lookups need not wait for all
+    old_builders = dict_registry.builders
+    reused = 0
+    to_build = []
+    for dict_entry in dict_ordered_list:
+        progress('%d#%s' % (dict_entry['id'], dict_entry['mdx']), DICT_STATE_PENDING, dict_entry['title'])
     for dict_entry in dict_ordered_list:
+        dicname = '%d#%s' % (dict_entry['id'], dict_entry['mdx'])
         dicbook_title = dic_library.get_field(dict_entry['id'], 'title', index_is_id=True)
-        if dict_entry['zipped']:
-            dicbook_fmt_path = dic_library.format_abspath(dict_entry['id'], 'ZIP', index_is_id=True)
-            from pathlib import Path
-            dicbook_basename = Path(dicbook_fmt_path).stem
-            print('unzip %s %s' % (dic_cache_dir, dicbook_basename))
-            dicbook_cache_dir = os.path.join(dic_cache_dir, dicbook_basename)
-            unzip(dicbook_fmt_path, dicbook_cache_dir)
-            mdx_filenames = list(Path(dicbook_cache_dir).rglob(dict_entry['mdx']))
-            for mdx_filename in mdx_filenames:
-                print('dict builder mdx %s' % mdx_filename)
-                builder = mdict_query.IndexBuilder(mdx_filename)
-                if builder:
-                    print('builder title: %s' % builder._title)
-                    dict_builders['%d#%s' % (dict_entry['id'], dict_entry['mdx'])] = {
-                            'id': dict_entry['id'],
-                            'title': dicbook_title,
-                            'basepath': os.path.dirname(mdx_filename),
-                            'basename': os.path.basename(mdx_filename), 
-                            'builder': builder
-                        }
+        try:
+            if dict_entry['zipped']:
+                dicbook_fmt_path = dic_library.format_abspath(dict_entry['id'], 'ZIP', index_is_id=True)
+            else:
+                dicbook_fmt_path = dict_entry['mdx']
+            record, changed, known = manifest.check(dicbook_fmt_path)
+        except Exception as e:
+            import traceback
+            traceback.print_exc()
+            progress(dicname, DICT_STATE_FAILED, dicbook_title, str(e))
+            continue
+
+        old_info = old_builders.get(dicname, None)
+        if not changed and old_info and old_info.get('source', None) == dicbook_fmt_path:
+            builders[dicname] = dict(old_info, title=dicbook_title)
+            reused += 1
+            progress(dicname, DICT_STATE_READY, dicbook_title)
+            continue
+        to_build.append((dicname, dicbook_title, dict_entry, dicbook_fmt_path, record, changed, known))
+
+    # an mdx replaced in place has its index databases removed before the rebuild,
+    # its old builder is withdrawn first so no lookup opens them meanwhile
+    withdrawn = [task[0] for task in to_build if not task[2]['zipped'] and task[5] and task[6] and task[0] in old_builders]
+    if withdrawn:
+        old_builders = dict((dicname, info) for dicname, info in old_builders.items() if dicname not in withdrawn)
+        publish_dict_registry(old_builders, dict_ordered_list, dict_library_name)
+
+    # indexes of different dictionaries are built side by side in worker processes
+    if index_workers is None:
+        index_workers = int(c.get(KEY_DICT_VIEWER_INDEX_WORKERS, DEFAULT_STORE_VALUES[KEY_DICT_VIEWER_INDEX_WORKERS]))
+    # several mdx of one zip share its manifest record and extraction
+    source_locks = dict((task[3], threading.Lock()) for task in to_build)
+    def build(task):
+        dicname, dicbook_title, dict_entry, dicbook_fmt_path, record, changed, known = task
+        progress(dicname, DICT_STATE_INDEXING, dicbook_title)
+        return build_dict_builder(dict_entry, dicbook_title, dicbook_fmt_path, record, changed, known, dic_cache_dir, mdict_query, index_workers, source_locks[dicbook_fmt_path])
+
+    def finished_builds():
+        if index_workers > 0 and len(to_build) > 1:
+            from concurrent.futures import ThreadPoolExecutor, as_completed
+            with ThreadPoolExecutor(max_workers=index_workers, thread_name_prefix='DictIndex') as pool:
+                futures = {pool.submit(build, task): task for task in to_build}
+                for future in as_completed(futures):
+                    yield futures[future], future.result
         else:
-            mdx_filename = dict_entry['mdx']
+            from functools import partial
+            for task in to_build:
+                yield task, partial(build, task)
+
+    for task, result in finished_builds():
+        dicname, dicbook_title = task[:2]
+        try:
+            info = result()
+        except Exception as e:
+            import traceback
+            traceback.print_exc()
+            progress(dicname, DICT_STATE_FAILED, dicbook_title, str(e))
+            continue
+        if info is None:
+            progress(dicname, DICT_STATE_FAILED, dicbook_title, 'no mdx found')
+            continue
+
+        builders[dicname] = info
+        merged = dict(old_builders)
+        merged.update(builders)
+        publish_dict_registry(merged, dict_ordered_list, dict_library_name)
+        progress(dicname, DICT_STATE_READY, dicbook_title)
+
+    manifest.retain(sources)
+    try:
+        manifest.save()
+    except Exception as e:
+        print('rebuild_dict_builders manifest not saved %s' % str(e))
+
+    # not published again when nothing was found, built or removed, as when calibre
+    # wrote metadata.db for other reasons, so the caches of all dictionaries stay
+    registry = dict_registry
+    if builders != registry.builders or tuple(dict_ordered_list) != registry.dict_ordered_list or dict_library_name != registry.dict_library_name:
+        publish_dict_registry(builders, dict_ordered_list, dict_library_name)
+    for dicbook_cache_dir in manifest.stale_extractions():
+        import shutil
+        print('rebuild_dict_builders remove replaced %s' % dicbook_cache_dir)
+        shutil.rmtree(dicbook_cache_dir, ignore_errors=True)
+    print('rebuild_dict_builders finish reused %d of %d %s' % (reused, len(builders), str(builders)))
+    return dict_ordered_list
+
+def dict_version(record):
+    '''
+    Version of a dictionary put into its resource urls and etags, taken
+    from the manifest record of its source so it stays the same across
+    restarts and changes with the file
+    '''
+    return record['hash'][:16]
+
+def build_dict_builder(dict_entry, dicbook_title, dicbook_fmt_path, record, changed, known, dic_cache_dir, mdict_query, index_workers=0, source_lock=None):
+    '''
+    source_lock, if given, is held while the zip is extracted, it must be
+    shared by the builds of all mdx of the same zip
+    '''
+    # builders are registered behind a handle, the memory governor may close idle ones
+    from functools import partial
+    from calibre_plugins.dsreader_helper.srv.dict_governor import DictBuilderHandle
+    if dict_entry['zipped']:
+        from pathlib import Path
+        from contextlib import nullcontext
+        with source_lock or nullcontext():
+            dicbook_basename = Path(dicbook_fmt_path).stem
+            dicbook_cache_dir = record.get('extracted', None)
+            if changed and known:
+                # the published builder keeps reading the old extraction until the
+                # new one is swapped in, the old one is removed after the rebuild
+                dicbook_basename = '%s-%s' % (dicbook_basename, record['hash'][:8])
+                dicbook_cache_dir = None
+            if not dicbook_cache_dir:
+                dicbook_cache_dir = os.path.join(dic_cache_dir, dicbook_basename)
+            if record.get('extracted', None) != dicbook_cache_dir or not os.path.isdir(dicbook_cache_dir):
+                print('unzip %s %s' % (dic_cache_dir, dicbook_basename))
+                # mdict_query opens mdx and mdd by path, other files are read from the zip
+                unzip(dicbook_fmt_path, dicbook_cache_dir, pattern='*.[mM][dD][xXdD]')
+                record['extracted'] = dicbook_cache_dir
+        mdx_filenames = list(Path(dicbook_cache_dir).rglob(dict_entry['mdx']))
+        zipfs = None
+        if mdx_filenames:
+            import posixpath
+            from calibre_plugins.dsreader_helper.srv.dict_zipfs import ZipFS
+            zipfs = ZipFS(dicbook_fmt_path, posixpath.dirname(dict_entry['mdx']))
+        info = None
+        for mdx_filename in mdx_filenames:
             print('dict builder mdx %s' % mdx_filename)
+            if index_workers > 0:
+                build_dict_index_in_worker(str(mdx_filename))
+            remove_invalid_dict_index(str(mdx_filename))
             builder = mdict_query.IndexBuilder(mdx_filename)
             if builder:
                 print('builder title: %s' % builder._title)
-                dict_builders['%d#%s' % (dict_entry['id'], dict_entry['mdx'])] = {
+                builder = DictBuilderHandle(mdx_filename, builder, partial(mdict_query.IndexBuilder, mdx_filename))
+                info = {
                         'id': dict_entry['id'],
                         'title': dicbook_title,
                         'basepath': os.path.dirname(mdx_filename),
                         'basename': os.path.basename(mdx_filename), 
+                        'source': dicbook_fmt_path,
+                        'version': dict_version(record),
+                        'zip': zipfs,
                         'builder': builder
                     }
-    
-    print('rebuild_dict_builders finish %s' % str(dict_builders))
+        return info
+    else:
+        mdx_filename = dict_entry['mdx']
+        print('dict builder mdx %s' % mdx_filename)
+        if changed and known:
+            # replaced in place, the index databases next to it are of the old one
+            remove_dict_index(mdx_filename)
+        if index_workers > 0:
+            build_dict_index_in_worker(mdx_filename)
+        remove_invalid_dict_index(mdx_filename)
+        builder = mdict_query.IndexBuilder(mdx_filename)
+        if builder:
+            print('builder title: %s' % builder._title)
+            builder = DictBuilderHandle(mdx_filename, builder, partial(mdict_query.IndexBuilder, mdx_filename))
+            return {
+                    'id': dict_entry['id'],
+                    'title': dicbook_title,
+                    'basepath': os.path.dirname(mdx_filename),
+                    'basename': os.path.basename(mdx_filename), 
+                    'source': dicbook_fmt_path,
+                    'version': dict_version(record),
+                    'builder': builder
+                }
+        return None
 
-    return dict_ordered_list
\ No newline at end of file
+def remove_dict_index(mdx_filename):
+    base = os.path.splitext(mdx_filename)[0]
+    for index_filename in (base + '.mdx.db', base + '.mdd.db'):
+        try:
+            os.remove(index_filename)
+            print('remove_dict_index %s' % index_filename)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            print('remove_dict_index failed %s %s' % (index_filename, str(e)))
+
+def remove_invalid_dict_index(mdx_filename):
+    '''
+    Remove index databases IndexBuilder would take as complete although
+    they are not, it only checks they exist
+    '''
+    from calibre_plugins.dsreader_helper.srv.dict_index import valid_index_database
+    base = os.path.splitext(mdx_filename)[0]
+    for index_filename in (base + '.mdx.db', base + '.mdd.db'):
+        if os.path.isfile(index_filename) and not valid_index_database(index_filename):
+            try:
+                os.remove(index_filename)
+                print('remove_invalid_dict_index %s' % index_filename)
+            except OSError as e:
+                print('remove_invalid_dict_index failed %s %s' % (index_filename, str(e)))
+
+DICT_INDEX_TIMEOUT = 3600
+
+def build_dict_index_in_worker(mdx_filename):
+    '''
+    Have a calibre worker process write the index databases mdict_query
+    keeps next to the mdx and mdd, opening the builder afterwards only
+    reads them. Nothing happens if valid ones are there already.
+    '''
+    from calibre_plugins.dsreader_helper.srv.dict_index import valid_index_database
+    base = os.path.splitext(mdx_filename)[0]
+    if valid_index_database(base + '.mdx.db') and (not os.path.isfile(base + '.mdd') or valid_index_database(base + '.mdd.db')):
+        return
+    remove_invalid_dict_index(mdx_filename)
+    from calibre.utils.ipc.simple_worker import fork_job, WorkerError
+    try:
+        res = fork_job('calibre_plugins.dsreader_helper.jobs', 'build_dict_index', (mdx_filename,), timeout=DICT_INDEX_TIMEOUT)
+        print('build_dict_index_in_worker %s' % str(res['result']))
+    except WorkerError as e:
+        # a killed or timed out worker may leave a partial database behind,
+        # which IndexBuilder would take as complete, it builds them afresh
+        print('build_dict_index_in_worker failed %s %s' % (mdx_filename, str(e)))
+        remove_dict_index(mdx_filename)
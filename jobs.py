@@ -28,3 +28,11 @@ def grsync_add_remove_book_to_shelf(goodreads_id, profile_name, shelf_name, acti
     results[goodreads_id] = ['grsync_add_remove_book_to_shelf', grhttp.add_remove_book_to_shelf(client, shelf_name, goodreads_id, action), 0]
 
     return results
+
+def build_dict_index(mdx_filename):
+    import sys
+    sys.path.append(os.path.dirname(__file__) + '/mdict_query')
+    from calibre_plugins.dsreader_helper.mdict_query import mdict_query
+    start = time.time()
+    builder = mdict_query.IndexBuilder(mdx_filename)
+    return {'mdx': mdx_filename, 'title': builder._title, 'seconds': time.time() - start}
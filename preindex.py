@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__ = 'GPL v3'
+__copyright__ = '2021 by Drearycold <drearycold at icloud.com>'
+__docformat__ = 'restructuredtext en'
+
+# Extract and index the dictionaries of the dictionary viewer without the
+# calibre GUI, so the next start of calibre finds everything in place:
+#
+#   calibre-debug -r "DSReader Helper" -- [--library NAME] [--workers N]
+#   calibre-debug -e preindex.py -- [--library NAME] [--workers N]
+
+import sys, time
+
+def validate_dict_builder(info):
+    '''
+    None if the builder answers a lookup from its index, else the problem
+    '''
+    from calibre_plugins.dsreader_helper.srv.dict_index import connect_index_database, valid_index_database
+    builder = info['builder']
+    mdx_db = getattr(builder, '_mdx_db', None)
+    if not mdx_db or not valid_index_database(mdx_db):
+        return 'no index database'
+    conn = connect_index_database(mdx_db)
+    try:
+        row = conn.execute('SELECT key_text FROM MDX_INDEX LIMIT 1').fetchone()
+    finally:
+        conn.close()
+    if row is None:
+        return 'empty index'
+    if not builder.mdx_lookup(row[0]):
+        return 'lookup of %r failed' % row[0]
+    mdd_db = getattr(builder, '_mdd_db', None)
+    if mdd_db and not valid_index_database(mdd_db):
+        return 'no mdd index database'
+    return None
+
+def main(args):
+    import argparse
+    parser = argparse.ArgumentParser(prog='preindex', description='Extract and index the dictionaries of the DSReader Helper dictionary viewer')
+    parser.add_argument('--library', help='name of the dictionary library, the configured one by default')
+    parser.add_argument('--workers', type=int, help='index worker processes, the configured number by default')
+    parser.add_argument('--no-validate', dest='validate', action='store_false', help='do not look up a word in every dictionary afterwards')
+    opts = parser.parse_args(args)
+
+    import calibre_plugins.dsreader_helper.config as cfg
+    c = cfg.plugin_prefs[cfg.STORE_NAME]
+    dict_library_name = opts.library or c.get(cfg.KEY_DICT_VIEWER_LIBRARY_NAME, cfg.DEFAULT_STORE_VALUES[cfg.KEY_DICT_VIEWER_LIBRARY_NAME])
+
+    states = {}
+    def progress(dicname, state, title, error=None):
+        states[dicname] = (title, state, error)
+        print('%-8s %s %s%s' % (state, dicname, title, (' (%s)' % error) if error else ''))
+
+    start = time.time()
+    dict_ordered_list = cfg.rebuild_dict_builders(dict_library_name, progress=progress, index_workers=opts.workers)
+    print('preindex %s: %d dictionaries in %.1f seconds' % (dict_library_name, len(dict_ordered_list), time.time() - start))
+
+    failed = [dicname for dicname, (title, state, error) in states.items() if state == cfg.DICT_STATE_FAILED]
+    if opts.validate:
+        for dicname, info in cfg.dict_registry.builders.items():
+            try:
+                problem = validate_dict_builder(info)
+            except Exception as e:
+                problem = str(e)
+            if problem:
+                print('invalid  %s %s (%s)' % (dicname, info['title'], problem))
+                failed.append(dicname)
+
+    if failed:
+        print('preindex failed for %d dictionaries' % len(failed))
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    import calibre.customize.ui  # noqa: F401 loads the installed plugins, calibre_plugins.* is importable afterwards
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,46 @@
+import zlib
+
+from calibre_plugins.dsreader_helper.srv.dict_cache import block_cache
+
+# mdict record block compression types handled here, lzo (1) is left to
+# mdict_query itself
+RECORD_BLOCK_NONE = 0
+RECORD_BLOCK_ZLIB = 2
+
+
+def install_block_cache(builder):
+    '''
+    Make the builder's record reads go through the shared cache of
+    decompressed record blocks, keyed by (file, block offset). Builders
+    without get_data_by_index are left alone, installing twice is a no-op.
+    '''
+    if getattr(builder, 'lazy', False):
+        return False    # installs on the builder it opens
+    original = getattr(builder, 'get_data_by_index', None)
+    if original is None or getattr(original, 'block_cached', False):
+        return False
+
+    def get_data_by_index(fmdx, index):
+        try:
+            block_type = index['record_block_type']
+            key = (fmdx.name, index['file_pos'])
+            start = index['record_start'] - index['offset']
+            end = index['record_end'] - index['offset']
+        except (KeyError, TypeError, AttributeError):
+            return original(fmdx, index)
+        if block_type not in (RECORD_BLOCK_NONE, RECORD_BLOCK_ZLIB):
+            return original(fmdx, index)
+
+        cache = block_cache()
+        block = cache.get(key)
+        if block is None:
+            fmdx.seek(index['file_pos'])
+            compressed = fmdx.read(index['compressed_size'])
+            # 4 bytes type, 4 bytes adler32, then the data
+            block = compressed[8:] if block_type == RECORD_BLOCK_NONE else zlib.decompress(compressed[8:])
+            cache.put(key, block)
+        return block[start:end]
+
+    get_data_by_index.block_cached = True
+    builder.get_data_by_index = get_data_by_index
+    return True
@@ -0,0 +1,181 @@
+from collections import OrderedDict
+from threading import Lock
+
+
+class ByteLRUCache:
+
+    def __init__(self, name, max_bytes):
+        self.name = name
+        self.max_bytes = max_bytes
+        self.lock = Lock()
+        self.items = OrderedDict()
+        self.size = 0
+        self.hits = self.misses = self.evictions = 0
+
+    def get(self, key, default=None):
+        with self.lock:
+            item = self.items.get(key, None)
+            if item is None:
+                self.misses += 1
+                return default
+            self.items.move_to_end(key)
+            self.hits += 1
+            return item[0]
+
+    def put(self, key, value, cost=None):
+        if cost is None:
+            cost = len(value)
+        if cost > self.max_bytes:
+            return
+        with self.lock:
+            old = self.items.pop(key, None)
+            if old is not None:
+                self.size -= old[1]
+                self.removed(key, old[1])
+            self.items[key] = (value, cost)
+            self.size += cost
+            self.added(key, cost)
+            while self.size > self.max_bytes:
+                old_key, (_, old_cost) = self.items.popitem(last=False)
+                self.size -= old_cost
+                self.removed(old_key, old_cost)
+                self.evictions += 1
+
+    def discard_where(self, predicate):
+        with self.lock:
+            for key in [key for key in self.items if predicate(key)]:
+                _, cost = self.items.pop(key)
+                self.size -= cost
+                self.removed(key, cost)
+
+    def bytes_by(self, group):
+        '''
+        Total cost of the entries per group(key)
+        '''
+        ans = {}
+        with self.lock:
+            for key, (_, cost) in self.items.items():
+                g = group(key)
+                ans[g] = ans.get(g, 0) + cost
+        return ans
+
+    def added(self, key, cost):
+        pass
+
+    def removed(self, key, cost):
+        pass
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+            self.size = 0
+            self.cleared()
+
+    def cleared(self):
+        pass
+
+    def stats(self):
+        with self.lock:
+            return {
+                'entries': len(self.items),
+                'bytes': self.size,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': self.hits / (self.hits + self.misses) if self.hits + self.misses else None,
+            }
+
+
+class ResourceCache(ByteLRUCache):
+
+    # keys are (dictionary name, resource path), NOT_FOUND is cached too as
+    # a miss costs an index scan of the mdd
+
+    NOT_FOUND = object()
+    NOT_FOUND_COST = 256
+
+    def __init__(self, name, max_bytes):
+        ByteLRUCache.__init__(self, name, max_bytes)
+        self.dictionary_bytes = {}
+
+    def put_not_found(self, key):
+        self.put(key, self.NOT_FOUND, self.NOT_FOUND_COST + len(key[1]))
+
+    def added(self, key, cost):
+        self.dictionary_bytes[key[0]] = self.dictionary_bytes.get(key[0], 0) + cost
+
+    def removed(self, key, cost):
+        remaining = self.dictionary_bytes.get(key[0], 0) - cost
+        if remaining > 0:
+            self.dictionary_bytes[key[0]] = remaining
+        else:
+            self.dictionary_bytes.pop(key[0], None)
+
+    def cleared(self):
+        self.dictionary_bytes.clear()
+
+    def stats(self):
+        ans = ByteLRUCache.stats(self)
+        with self.lock:
+            ans['dictionaries'] = dict(self.dictionary_bytes)
+        return ans
+
+
+def cache_size_pref(key):
+    import calibre_plugins.dsreader_helper.config as cfg
+    c = cfg.plugin_prefs[cfg.STORE_NAME]
+    return int(c.get(key, cfg.DEFAULT_STORE_VALUES[key])) * 1024 * 1024
+
+
+_caches = {}
+_caches_lock = Lock()
+
+
+def get_cache(name, size_key, cache_class=ByteLRUCache):
+    with _caches_lock:
+        cache = _caches.get(name, None)
+        if cache is None:
+            cache = _caches[name] = cache_class(name, cache_size_pref(size_key))
+        return cache
+
+
+def lookup_cache():
+    import calibre_plugins.dsreader_helper.config as cfg
+    return get_cache('lookup', cfg.KEY_DICT_VIEWER_LOOKUP_CACHE_SIZE)
+
+
+def resource_cache():
+    import calibre_plugins.dsreader_helper.config as cfg
+    return get_cache('resource', cfg.KEY_DICT_VIEWER_RESOURCE_CACHE_SIZE, ResourceCache)
+
+
+def css_cache():
+    import calibre_plugins.dsreader_helper.config as cfg
+    return get_cache('css', cfg.KEY_DICT_VIEWER_CSS_CACHE_SIZE)
+
+
+def inline_cache():
+    import calibre_plugins.dsreader_helper.config as cfg
+    return get_cache('inline', cfg.KEY_DICT_VIEWER_INLINE_CACHE_SIZE)
+
+
+def block_cache():
+    import calibre_plugins.dsreader_helper.config as cfg
+    return get_cache('block', cfg.KEY_DICT_VIEWER_BLOCK_CACHE_SIZE)
+
+
+def discard_dictionary(dicname, owns_file):
+    '''
+    Drop the cached resources and stylesheets of dicname, and the cached
+    record blocks of the files owns_file(path) is true for
+    '''
+    for cache in (resource_cache(), inline_cache(), css_cache()):
+        cache.discard_where(lambda key: key[0] == dicname)
+    block_cache().discard_where(lambda key: owns_file(key[0]))
+
+
+def cache_stats():
+    with _caches_lock:
+        caches = list(_caches.values())
+    return {cache.name: cache.stats() for cache in caches}
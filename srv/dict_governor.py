@@ -0,0 +1,169 @@
+import os
+import sys
+import time
+from threading import Lock
+
+import calibre_plugins.dsreader_helper.config as cfg
+from calibre_plugins.dsreader_helper.srv.dict_blocks import install_block_cache
+from calibre_plugins.dsreader_helper.srv.dict_cache import (resource_cache, inline_cache, block_cache)
+from calibre_plugins.dsreader_helper.srv.dict_index import (loaded_headword_index, release_index)
+
+COLLECT_INTERVAL = 30
+
+
+class DictBuilderHandle:
+
+    '''
+    Stands in for an mdict_query builder in the registry. Attribute access
+    is passed on to the builder, which is opened again by opener() after
+    it has been unloaded, and marks the dictionary as used.
+    '''
+
+    lazy = True
+
+    def __init__(self, mdx_filename, builder, opener):
+        self.mdx_filename = str(mdx_filename)
+        self.opener = opener
+        self.lock = Lock()
+        self.builder = builder
+        self.last_used = time.time()
+        self.loads = 1
+        self.unloads = 0
+        install_block_cache(builder)
+
+    def __repr__(self):
+        return 'DictBuilderHandle(%r, loaded=%s)' % (self.mdx_filename, self.builder is not None)
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        return getattr(self.acquire(), name)
+
+    def acquire(self):
+        with self.lock:
+            if self.builder is None:
+                print('DictBuilderHandle reopen %s' % self.mdx_filename)
+                self.builder = self.opener()
+                install_block_cache(self.builder)
+                self.loads += 1
+            self.last_used = time.time()
+            return self.builder
+
+    def unload(self):
+        with self.lock:
+            if self.builder is None:
+                return False
+            self.builder = None
+            self.unloads += 1
+            return True
+
+    def owns_file(self, path):
+        return os.path.splitext(str(path))[0] == os.path.splitext(self.mdx_filename)[0]
+
+
+def builder_nbytes(builder):
+    # shallow estimate, the record data itself stays in the files and sqlite
+    try:
+        return sys.getsizeof(builder) + sum(sys.getsizeof(v) for v in vars(builder).values())
+    except TypeError:
+        return sys.getsizeof(builder)
+
+
+def dictionary_memory(registry=None):
+    '''
+    (dicname, title, handle, bytes) for every dictionary of the registry,
+    bytes maps builder, index, resources and blocks to their size
+    '''
+    if registry is None:
+        registry = cfg.dict_registry
+    resource_bytes = resource_cache().bytes_by(lambda key: key[0])
+    resource_bytes_inline = inline_cache().bytes_by(lambda key: key[0])
+    block_bytes = block_cache().bytes_by(lambda key: key[0])
+    ans = []
+    for _, title, handle, dicname in registry.entries:
+        loaded = handle.builder if getattr(handle, 'lazy', False) else handle
+        index = loaded_headword_index(handle)
+        sizes = {
+            'builder': builder_nbytes(loaded) if loaded else 0,
+            'index': index.nbytes() if index is not None else 0,
+            'resources': resource_bytes.get(dicname, 0) + resource_bytes_inline.get(dicname, 0),
+            'blocks': sum(n for path, n in block_bytes.items() if getattr(handle, 'lazy', False) and handle.owns_file(path)),
+        }
+        sizes['total'] = sum(sizes.values())
+        ans.append((dicname, title, handle, sizes))
+    return ans
+
+
+def unload_dictionary(dicname, handle):
+    handle.unload()
+    release_index(handle)
+    resource_cache().discard_where(lambda key: key[0] == dicname)
+    inline_cache().discard_where(lambda key: key[0] == dicname)
+    block_cache().discard_where(lambda key: handle.owns_file(key[0]))
+
+
+def governor_options():
+    c = cfg.plugin_prefs[cfg.STORE_NAME]
+    budget = int(c.get(cfg.KEY_DICT_VIEWER_MEMORY_BUDGET, cfg.DEFAULT_STORE_VALUES[cfg.KEY_DICT_VIEWER_MEMORY_BUDGET])) * 1024 * 1024
+    idle_time = float(c.get(cfg.KEY_DICT_VIEWER_IDLE_TIME, cfg.DEFAULT_STORE_VALUES[cfg.KEY_DICT_VIEWER_IDLE_TIME]))
+    return budget, idle_time
+
+
+_collect_lock = Lock()
+_last_collect = 0
+
+
+def collect(force=False):
+    '''
+    Unload the least recently used dictionaries idle for longer than the
+    idle time while the dictionaries together use more than the budget.
+    Runs at most every COLLECT_INTERVAL seconds unless forced, returns the
+    names of the unloaded dictionaries.
+    '''
+    global _last_collect
+    budget, idle_time = governor_options()
+    if budget <= 0:
+        return []
+    now = time.time()
+    if not force and now - _last_collect < COLLECT_INTERVAL:
+        return []
+    if not _collect_lock.acquire(blocking=False):
+        return []
+    try:
+        _last_collect = now
+        memory = dictionary_memory()
+        total = sum(sizes['total'] for _, _, _, sizes in memory)
+        unloaded = []
+        idle = sorted((m for m in memory if getattr(m[2], 'lazy', False) and now - m[2].last_used > idle_time and m[3]['total']),
+                      key=lambda m: m[2].last_used)
+        for dicname, title, handle, sizes in idle:
+            if total <= budget:
+                break
+            unload_dictionary(dicname, handle)
+            total -= sizes['total']
+            unloaded.append(dicname)
+        if unloaded:
+            print('dict_governor unloaded %s, %d bytes left of %d' % (', '.join(unloaded), total, budget))
+        return unloaded
+    finally:
+        _collect_lock.release()
+
+
+def memory_info():
+    budget, idle_time = governor_options()
+    now = time.time()
+    dictionaries = []
+    total = 0
+    for dicname, title, handle, sizes in dictionary_memory():
+        lazy = getattr(handle, 'lazy', False)
+        total += sizes['total']
+        dictionaries.append({
+            'name': dicname,
+            'title': title,
+            'loaded': handle.builder is not None if lazy else True,
+            'idle': now - handle.last_used if lazy else None,
+            'loads': handle.loads if lazy else None,
+            'unloads': handle.unloads if lazy else None,
+            'bytes': sizes,
+        })
+    return {'budget': budget, 'idle_time': idle_time, 'total': total, 'dictionaries': dictionaries}
@@ -0,0 +1,212 @@
+import bisect
+import heapq
+import sqlite3
+from array import array
+from itertools import islice
+from threading import Lock
+from urllib.request import pathname2url
+from weakref import WeakKeyDictionary
+
+from calibre_plugins.dsreader_helper.srv.dict_prefetch import PrefetchQueue
+
+SIMILAR_RANK_POOL = 5
+
+
+class PackedStrings:
+
+    # read-only sequence of strings stored as one str plus an offset array,
+    # much smaller than a list of str objects for a few hundred thousand keys
+
+    def __init__(self, strings):
+        offsets = array('L', [0])
+        pos = 0
+        for s in strings:
+            pos += len(s)
+            offsets.append(pos)
+        self.data = ''.join(strings)
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        return self.data[self.offsets[i]:self.offsets[i+1]]
+
+    def nbytes(self):
+        return len(self.data.encode('utf-8')) + self.offsets.itemsize * len(self.offsets)
+
+
+class HeadwordIndex:
+
+    def __init__(self):
+        self.lock = Lock()
+        self.folded = self.keys = None
+
+    def load(self, builder):
+        with self.lock:
+            if self.keys is None:
+                pairs = sorted(set((key.casefold(), key) for key in builder.get_mdx_keys()))
+                print('HeadwordIndex loaded %d keys for %s' % (len(pairs), str(builder)))
+                self.folded = PackedStrings([p[0] for p in pairs])
+                self.keys = PackedStrings([p[1] for p in pairs])
+        return self
+
+    def prefixed(self, prefix):
+        prefix = prefix.casefold()
+        folded, keys = self.folded, self.keys
+        i = bisect.bisect_left(folded, prefix)
+        while i < len(folded):
+            f = folded[i]
+            if not f.startswith(prefix):
+                break
+            yield f, keys[i]
+            i += 1
+
+    def nbytes(self):
+        if self.keys is None:
+            return 0
+        return self.folded.nbytes() + self.keys.nbytes()
+
+
+_indexes = WeakKeyDictionary()
+_indexes_lock = Lock()
+
+
+def headword_index(builder):
+    with _indexes_lock:
+        index = _indexes.get(builder, None)
+        if index is None:
+            index = _indexes[builder] = HeadwordIndex()
+    return index.load(builder)
+
+
+index_queue = PrefetchQueue('index', headword_index)
+
+
+def queued_headword_index(builder):
+    '''
+    The loaded headword index of builder, or None after queueing it to be
+    loaded by the index thread, the full key scan can take many seconds
+    '''
+    index = loaded_headword_index(builder)
+    if index is None:
+        index_queue.put(builder)
+    return index
+
+
+def release_indexes(keep=()):
+    '''
+    Drop the headword indexes, except those of the builders in keep
+    '''
+    keep = set(keep)
+    with _indexes_lock:
+        for builder in list(_indexes.keys()):
+            if builder not in keep:
+                del _indexes[builder]
+
+
+def release_index(builder):
+    with _indexes_lock:
+        _indexes.pop(builder, None)
+
+
+def merged_prefixed(indexes, prefix, limit):
+    '''
+    k-way merge of the prefix matches of every index, returns at most limit
+    distinct headwords mapped to the number of dictionaries containing them
+    '''
+    result = {}
+    for folded, key in heapq.merge(*(index.prefixed(prefix) for index in indexes)):
+        if key not in result and len(result) >= limit:
+            break
+        result[key] = result.get(key, 0) + 1
+    return result
+
+
+def loaded_headword_index(builder):
+    with _indexes_lock:
+        index = _indexes.get(builder, None)
+    if index is None or index.keys is None:
+        return None
+    return index
+
+
+def edit_distance(a, b):
+    if len(a) < len(b):
+        a, b = b, a
+    previous = list(range(len(b) + 1))
+    for i, ca in enumerate(a, 1):
+        current = [i]
+        for j, cb in enumerate(b, 1):
+            current.append(min(previous[j] + 1, current[j-1] + 1, previous[j-1] + (ca != cb)))
+        previous = current
+    return previous[-1]
+
+
+def connect_index_database(path):
+    # read-only, so a database removed for a rebuild is not recreated empty
+    return sqlite3.connect('file:%s?mode=ro' % pathname2url(path), uri=True)
+
+
+def valid_index_database(path):
+    '''
+    Whether path is an index database mdict_query finished writing, not a
+    missing file or an empty one left behind by a connect to a missing file
+    '''
+    try:
+        conn = connect_index_database(path)
+    except sqlite3.Error:
+        return False
+    try:
+        return conn.execute('SELECT 1 FROM sqlite_master WHERE type = \'table\' AND name = \'MDX_INDEX\'').fetchone() is not None
+    except sqlite3.Error:
+        return False
+    finally:
+        conn.close()
+
+
+def prefixed_keys(builder, prefix, limit):
+    '''
+    At most limit headwords starting with prefix, a * in prefix matches
+    anything as in mdict_query's get_mdx_keys
+    '''
+    wildcard = '*' in prefix
+    index = None if wildcard else loaded_headword_index(builder)
+    if index is not None:
+        return [key for _, key in islice(index.prefixed(prefix), limit)]
+
+    mdx_db = getattr(builder, '_mdx_db', None)
+    if not mdx_db:
+        return list(islice(builder.get_mdx_keys(prefix), limit))
+
+    pattern = prefix.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+    pattern = pattern.replace('*', '%') if wildcard else pattern + '%'
+    conn = connect_index_database(mdx_db)
+    try:
+        cursor = conn.execute('SELECT key_text FROM MDX_INDEX WHERE key_text LIKE ? ESCAPE \'\\\' LIMIT ?', (pattern, limit))
+        return [row[0] for row in cursor]
+    finally:
+        conn.close()
+
+
+def similar_words(builder, word, limit, ranked=False):
+    '''
+    Headwords starting with word, excluding word itself in any case. The
+    prefix scan stops after limit such keys, or after a few times limit
+    when ranking the candidates by edit distance.
+    '''
+    if limit <= 0:
+        return []
+    wanted = limit * SIMILAR_RANK_POOL if ranked else limit
+    fetch = wanted + 1
+    while True:
+        keys = prefixed_keys(builder, word, fetch)
+        words = [w for w in keys if w.lower() != word.lower()]
+        # word may be there in several cases, read on until enough are left
+        if len(keys) < fetch or len(words) >= wanted:
+            break
+        fetch += len(keys) - len(words)
+    if ranked:
+        folded = word.casefold()
+        words.sort(key=lambda w: (edit_distance(w.casefold(), folded), len(w), w))
+    return words[:limit]
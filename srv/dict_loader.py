@@ -0,0 +1,176 @@
+import os
+import time
+import traceback
+from collections import OrderedDict
+from threading import Condition, Event, Thread
+
+import calibre_plugins.dsreader_helper.config as cfg
+
+
+class DictLoader:
+
+    '''
+    Runs rebuild_dict_builders on a background thread and keeps the
+    DICT_STATE_* of every dictionary, so neither calibre's startup nor the
+    dictionary server waits for indexes to be built. A start() while
+    loading runs one more rebuild afterwards. A reload (started by the
+    watcher) is invisible to lookups, the published registry serves the
+    old builders until new ones are swapped in.
+    '''
+
+    def __init__(self):
+        self.cond = Condition()
+        self.states = OrderedDict()     # dicname -> {'title', 'state', 'error', 'time'}
+        self.running = False
+        self.again = False
+        self.reload = self.reload_again = False
+        self.dict_library_name = None
+        self.started = self.finished = None
+
+    def start(self, dict_library_name=None, reload=False):
+        with self.cond:
+            self.dict_library_name = dict_library_name
+            if self.running:
+                self.reload_again = reload if not self.again else (self.reload_again and reload)
+                self.again = True
+                return
+            self.running = True
+            self.reload = reload
+        Thread(target=self.run, name='DictLoader', daemon=True).start()
+
+    def run(self):
+        while True:
+            with self.cond:
+                dict_library_name = self.dict_library_name
+                self.started = time.time()
+                self.states.clear()
+            try:
+                cfg.rebuild_dict_builders(dict_library_name, progress=self.progress)
+            except Exception as e:
+                print('DictLoader exception %s' % str(e))
+                traceback.print_exc()
+            with self.cond:
+                self.finished = time.time()
+                if not self.again:
+                    self.running = False
+                    self.cond.notify_all()
+                    return
+                self.again = False
+                self.reload = self.reload_again
+
+    def progress(self, dicname, state, title, error=None):
+        with self.cond:
+            self.states[dicname] = {'title': title, 'state': state, 'error': error, 'time': time.time()}
+            self.cond.notify_all()
+
+    def not_ready(self):
+        '''
+        (dicname, title) of the dictionaries still pending or indexing that
+        the published registry has no builder for, none during a reload
+        '''
+        registry = cfg.dict_registry
+        with self.cond:
+            if self.reload:
+                return []
+            return [(dicname, s['title']) for dicname, s in self.states.items()
+                    if s['state'] in (cfg.DICT_STATE_PENDING, cfg.DICT_STATE_INDEXING) and registry.get(dicname) is None]
+
+    def wait_ready(self, dicnames, timeout):
+        '''
+        Wait until none of dicnames is pending or indexing any more, at most
+        timeout seconds, however long the rest of the loading takes. True if
+        they are done.
+        '''
+        deadline = time.monotonic() + timeout
+        loading = (cfg.DICT_STATE_PENDING, cfg.DICT_STATE_INDEXING)
+        with self.cond:
+            while any(self.states.get(dicname, {}).get('state', None) in loading for dicname in dicnames):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self.cond.wait(remaining)
+            return True
+
+    def info(self):
+        with self.cond:
+            counts = {}
+            for s in self.states.values():
+                counts[s['state']] = counts.get(s['state'], 0) + 1
+            return {
+                'running': self.running,
+                'reload': self.reload,
+                'started': self.started,
+                'finished': self.finished,
+                'counts': counts,
+                'dictionaries': [dict(s, name=dicname) for dicname, s in self.states.items()],
+            }
+
+
+
+class DictLibraryWatcher:
+
+    '''
+    Polls the metadata.db of the dictionary library, which calibre writes
+    whenever books or formats are added, replaced or removed, and has the
+    loader reload the dictionaries in the background when it changed or
+    another library was chosen.
+    '''
+
+    def __init__(self, loader):
+        self.loader = loader
+        self.stop_event = Event()
+        self.thread = None
+        self.signature = None
+        self.checks = self.reloads = 0
+
+    def start(self):
+        if self.thread is None:
+            self.signature = self.library_signature()
+            self.thread = Thread(target=self.run, name='DictLibraryWatcher', daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+
+    def interval(self):
+        c = cfg.plugin_prefs[cfg.STORE_NAME]
+        return float(c.get(cfg.KEY_DICT_VIEWER_WATCH_INTERVAL, cfg.DEFAULT_STORE_VALUES[cfg.KEY_DICT_VIEWER_WATCH_INTERVAL]))
+
+    def library_signature(self):
+        c = cfg.plugin_prefs[cfg.STORE_NAME]
+        dict_library_name = c.get(cfg.KEY_DICT_VIEWER_LIBRARY_NAME, cfg.DEFAULT_STORE_VALUES[cfg.KEY_DICT_VIEWER_LIBRARY_NAME])
+        from calibre.srv.library_broker import load_gui_libraries
+        for library_path in load_gui_libraries():
+            if os.path.basename(library_path) == dict_library_name:
+                try:
+                    st = os.stat(os.path.join(library_path, 'metadata.db'))
+                except OSError:
+                    return (library_path, None, None)
+                return (library_path, st.st_mtime, st.st_size)
+        return None
+
+    def run(self):
+        while True:
+            interval = self.interval()
+            if self.stop_event.wait(interval if interval > 0 else 60):
+                return
+            if interval <= 0:
+                continue
+            try:
+                self.checks += 1
+                signature = self.library_signature()
+                if signature != self.signature:
+                    print('DictLibraryWatcher dictionary library changed %s' % str(signature))
+                    self.signature = signature
+                    self.reloads += 1
+                    self.loader.start(reload=True)
+            except Exception as e:
+                print('DictLibraryWatcher exception %s' % str(e))
+                traceback.print_exc()
+
+    def info(self):
+        return {'interval': self.interval(), 'checks': self.checks, 'reloads': self.reloads}
+
+
+dict_loader = DictLoader()
+dict_watcher = DictLibraryWatcher(dict_loader)
@@ -0,0 +1,114 @@
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from threading import Condition, Lock
+
+import calibre_plugins.dsreader_helper.config as cfg
+
+RESULT_OK = 'ok'
+RESULT_TIMEOUT = 'timeout'
+RESULT_ERROR = 'error'
+
+_pool = None
+_pool_lock = Lock()
+_stuck = {}     # key -> tasks still running after their caller timed out
+_stuck_lock = Lock()
+
+
+def lookup_options():
+    c = cfg.plugin_prefs[cfg.STORE_NAME]
+    workers = int(c.get(cfg.KEY_DICT_VIEWER_LOOKUP_WORKERS, cfg.DEFAULT_STORE_VALUES[cfg.KEY_DICT_VIEWER_LOOKUP_WORKERS]))
+    timeout = float(c.get(cfg.KEY_DICT_VIEWER_LOOKUP_TIMEOUT, cfg.DEFAULT_STORE_VALUES[cfg.KEY_DICT_VIEWER_LOOKUP_TIMEOUT]))
+    return workers, timeout
+
+
+def lookup_pool(workers):
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='DictLookup')
+        return _pool
+
+
+def stuck_release(key):
+    with _stuck_lock:
+        _stuck[key] -= 1
+        if not _stuck[key]:
+            del _stuck[key]
+
+
+def stuck_add(key, future):
+    with _stuck_lock:
+        _stuck[key] = _stuck.get(key, 0) + 1
+    future.add_done_callback(lambda f: stuck_release(key))
+
+
+def stuck_keys():
+    with _stuck_lock:
+        return dict(_stuck)
+
+
+def fan_out(func, items, key=None):
+    '''
+    Call func(item) for every item, yielding (item, status, result) in the
+    order of items. With workers > 0 the items are submitted to a bounded
+    thread pool and each one gets `timeout` seconds from the moment it
+    starts running. An item whose key(item) (the item itself by default)
+    still has a task running past its timeout is not submitted again until
+    that task returns, it times out right away.
+    '''
+    workers, timeout = lookup_options()
+    if workers <= 0 or len(items) < 2:
+        for item in items:
+            try:
+                yield item, RESULT_OK, func(item)
+            except Exception as e:
+                print('dict_lookup fan_out exception %s %s' % (str(item), str(e)))
+                traceback.print_exc()
+                yield item, RESULT_ERROR, None
+        return
+
+    if key is None:
+        key = lambda item: item
+    pool = lookup_pool(workers)
+    cond = Condition()
+    started = {}
+
+    def run(i, item):
+        with cond:
+            started[i] = time.monotonic()
+            cond.notify_all()
+        return func(item)
+
+    stuck = stuck_keys()
+    futures = [None if key(item) in stuck else pool.submit(run, i, item) for i, item in enumerate(items)]
+    # time enough for every item to get a turn in the pool, a queued item
+    # waits no longer than that for a free worker
+    queue_deadline = time.monotonic() + timeout * (1 + len(items) // workers)
+    for i, (item, future) in enumerate(zip(items, futures)):
+        if future is None:
+            print('dict_lookup fan_out skipping %s, still busy with an earlier lookup' % str(item))
+            yield item, RESULT_TIMEOUT, None
+            continue
+        with cond:
+            while i not in started:
+                remaining = queue_deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                cond.wait(remaining)
+            start = started.get(i, None)
+        if start is None:
+            if future.cancel():
+                print('dict_lookup fan_out timeout %s, never started' % str(item))
+                yield item, RESULT_TIMEOUT, None
+                continue
+            start = time.monotonic()    # started just now
+        try:
+            yield item, RESULT_OK, future.result(timeout=max(0, start + timeout - time.monotonic()))
+        except FutureTimeoutError:
+            stuck_add(key(item), future)
+            print('dict_lookup fan_out timeout %s' % str(item))
+            yield item, RESULT_TIMEOUT, None
+        except Exception as e:
+            print('dict_lookup fan_out exception %s %s' % (str(item), str(e)))
+            yield item, RESULT_ERROR, None
@@ -0,0 +1,88 @@
+import hashlib
+import json
+import os
+
+MANIFEST_NAME = 'manifest.json'
+MANIFEST_VERSION = 1
+QUICK_HASH_BLOCK = 64 * 1024
+
+
+def quick_hash(path, size):
+    '''
+    sha1 of the size and the first and last blocks of the file, enough to
+    tell a replaced dictionary from a touched one without reading it all
+    '''
+    h = hashlib.sha1(str(size).encode('utf-8'))
+    with open(path, 'rb') as f:
+        h.update(f.read(QUICK_HASH_BLOCK))
+        if size > QUICK_HASH_BLOCK:
+            f.seek(max(QUICK_HASH_BLOCK, size - QUICK_HASH_BLOCK))
+            h.update(f.read(QUICK_HASH_BLOCK))
+    return h.hexdigest()
+
+
+class DictManifest:
+
+    # source path (ZIP or MDX format file) -> {'size', 'mtime', 'hash', ...}
+    # as of the last rebuild, stored in the dictionary cache directory
+
+    def __init__(self, dic_cache_dir):
+        self.path = os.path.join(dic_cache_dir, MANIFEST_NAME)
+        self.sources = {}
+        self.checked = {}
+        self.replaced = []
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                manifest = json.load(f)
+            if manifest.get('version', None) == MANIFEST_VERSION:
+                self.sources = manifest.get('sources', {})
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            print('DictManifest ignoring %s: %s' % (self.path, str(e)))
+
+    def check(self, source):
+        '''
+        (record, changed, known): known is False for a source not in the
+        manifest, changed is True when the file differs from the recorded one
+        '''
+        if source in self.checked:
+            return self.checked[source]
+        old = self.sources.get(source, None)
+        st = os.stat(source)
+        if old and old.get('size', None) == st.st_size and old.get('mtime', None) == st.st_mtime:
+            result = old, False, True
+        else:
+            digest = quick_hash(source, st.st_size)
+            changed = not old or old.get('hash', None) != digest
+            record = {} if changed else dict(old)
+            if changed and old and old.get('extracted', None):
+                self.replaced.append(old['extracted'])
+            record.update({'size': st.st_size, 'mtime': st.st_mtime, 'hash': digest})
+            self.sources[source] = record
+            result = record, changed, old is not None
+        self.checked[source] = result
+        return result
+
+    def retain(self, sources):
+        for source in list(self.sources):
+            if source not in sources:
+                print('DictManifest removed %s' % source)
+                record = self.sources.pop(source)
+                if record.get('extracted', None):
+                    self.replaced.append(record['extracted'])
+
+    def stale_extractions(self):
+        '''
+        Extraction directories of replaced or removed zips no source uses
+        any more
+        '''
+        in_use = set(record.get('extracted', None) for record in self.sources.values())
+        return [d for d in self.replaced if d not in in_use]
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump({'version': MANIFEST_VERSION, 'sources': self.sources}, f, indent=1)
+        os.replace(tmp, self.path)
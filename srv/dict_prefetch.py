@@ -0,0 +1,62 @@
+import traceback
+from collections import OrderedDict
+from threading import Condition, Thread
+
+PREFETCH_QUEUE_SIZE = 256
+
+
+class PrefetchQueue:
+
+    # keys waiting to be passed to func by a single daemon thread. A key
+    # already queued is not added twice, when full the oldest key is dropped
+    # since the newest page is the one the browser is loading
+
+    def __init__(self, name, func, max_items=PREFETCH_QUEUE_SIZE):
+        self.name = name
+        self.func = func
+        self.max_items = max_items
+        self.cond = Condition()
+        self.pending = OrderedDict()
+        self.thread = None
+        self.queued = self.duplicates = self.dropped = self.done = self.failed = 0
+
+    def put(self, key):
+        with self.cond:
+            if key in self.pending:
+                self.duplicates += 1
+                return
+            self.pending[key] = True
+            self.queued += 1
+            while len(self.pending) > self.max_items:
+                self.pending.popitem(last=False)
+                self.dropped += 1
+            if self.thread is None:
+                self.thread = Thread(target=self.run, name='DictPrefetch-' + self.name, daemon=True)
+                self.thread.start()
+            self.cond.notify()
+
+    def run(self):
+        while True:
+            with self.cond:
+                while not self.pending:
+                    self.cond.wait()
+                key = self.pending.popitem(last=False)[0]
+            try:
+                self.func(key)
+                self.done += 1
+            except Exception as e:
+                self.failed += 1
+                print('dict_prefetch %s exception %s %s' % (self.name, str(key), str(e)))
+                traceback.print_exc()
+
+    def stats(self):
+        with self.cond:
+            return {
+                'pending': len(self.pending),
+                'max_items': self.max_items,
+                'queued': self.queued,
+                'duplicates': self.duplicates,
+                'dropped': self.dropped,
+                'done': self.done,
+                'failed': self.failed,
+            }
@@ -0,0 +1,150 @@
+import hashlib
+import mimetypes
+import os
+import re
+from collections import namedtuple
+from types import MappingProxyType
+from zipfile import ZipFile
+
+# resource urls carry the version of their dictionary (v=), derived from
+# the hash of its file, so a response never changes for a given url and
+# can be cached by the browser for good
+CACHE_CONTROL_IMMUTABLE = 'public, max-age=31536000, immutable'
+
+
+def resource_etag(*parts):
+    etag = hashlib.sha1()
+    for part in parts:
+        etag.update(str(part).encode('utf-8'))
+        etag.update(b'\0')
+    return '"%s"' % etag.hexdigest()
+
+
+def etag_matches(rd, etag):
+    none_match = rd.inheaders.get('If-None-Match', None)
+    if not none_match:
+        return False
+    for candidate in none_match.split(','):
+        candidate = candidate.strip()
+        if candidate.startswith('W/'):
+            candidate = candidate[2:]
+        if candidate == '*' or candidate == etag:
+            return True
+    return False
+
+
+StaticAsset = namedtuple('StaticAsset', 'data content_type etag')
+
+CONTENT_TYPES = {
+    '.js': 'text/javascript; charset=UTF-8',
+    '.css': 'text/css; charset=UTF-8',
+    '.html': 'text/html; charset=UTF-8',
+    '.svg': 'image/svg+xml',
+    '.mp3': 'audio/mpeg',
+    '.spx': 'audio/ogg',
+    '.ogg': 'audio/ogg',
+    '.oga': 'audio/ogg',
+    '.wav': 'audio/wav',
+    '.m4a': 'audio/mp4',
+    '.aac': 'audio/aac',
+    '.woff': 'font/woff',
+    '.woff2': 'font/woff2',
+    '.ttf': 'font/ttf',
+}
+
+MAGIC_CONTENT_TYPES = (
+    (b'\x89PNG', 'image/png'),
+    (b'\xff\xd8\xff', 'image/jpeg'),
+    (b'GIF8', 'image/gif'),
+    (b'ID3', 'audio/mpeg'),
+    (b'\xff\xfb', 'audio/mpeg'),
+    (b'\xff\xf3', 'audio/mpeg'),
+    (b'OggS', 'audio/ogg'),
+    (b'<svg', 'image/svg+xml'),
+)
+
+
+def resource_content_type(path, data=None):
+    ext = os.path.splitext(path)[1].lower()
+    if ext in CONTENT_TYPES:
+        return CONTENT_TYPES[ext]
+    ct = mimetypes.guess_type('x' + ext)[0]
+    if ct is None and data is not None:
+        for magic, magic_ct in MAGIC_CONTENT_TYPES:
+            if data.startswith(magic):
+                return magic_ct
+        if data[:4] == b'RIFF' and data[8:12] == b'WAVE':
+            return 'audio/wav'
+    return ct or 'application/octet-stream'
+
+
+def parse_range(rd, length, etag):
+    '''
+    The (start, stop) slice requested by a single-range Range header, None
+    to send the whole resource, or False if the range cannot be satisfied.
+    '''
+    header = rd.inheaders.get('Range', None)
+    if not header or not header.strip().startswith('bytes='):
+        return None
+    if_range = rd.inheaders.get('If-Range', None)
+    if if_range and if_range.strip() != etag:
+        return None
+    spec = header.strip()[len('bytes='):]
+    if ',' in spec:
+        return None
+    first, sep, last = (part.strip() for part in spec.partition('-'))
+    # a range that is not valid is ignored as if there was no header (RFC 9110 14.2)
+    if not sep or not (first or last) or not all(part.isdigit() for part in (first, last) if part):
+        return None
+    if not first:
+        suffix = int(last)
+        if suffix <= 0:
+            return False
+        return max(0, length - suffix), length
+    start = int(first)
+    stop = int(last) + 1 if last else length
+    if last and stop <= start:
+        return None
+    if start >= length:
+        return False
+    return start, min(stop, length)
+
+
+def load_static_assets(plugin_path):
+    '''
+    Read every file under static/ of the plugin (a zip file, or a directory
+    when running from source) once, keyed by the path below static/.
+    '''
+    files = {}
+    if os.path.isdir(plugin_path):
+        static_dir = os.path.join(plugin_path, 'static')
+        for dirpath, dirnames, filenames in os.walk(static_dir):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                with open(path, 'rb') as f:
+                    files[os.path.relpath(path, static_dir).replace(os.sep, '/')] = f.read()
+    else:
+        with ZipFile(plugin_path, 'r') as zf:
+            for name in zf.namelist():
+                if name.startswith('static/') and not name.endswith('/'):
+                    files[name[len('static/'):]] = zf.read(name)
+
+    assets = {}
+    for name, data in files.items():
+        assets[name] = StaticAsset(data, resource_content_type(name), resource_etag(hashlib.sha1(data).hexdigest()))
+    print('load_static_assets %s' % ', '.join(sorted(assets)))
+    return MappingProxyType(assets)
+
+
+# one pass over the stylesheet with the same effect as the former three
+# re.sub calls: any *color property takes the text colour, background and
+# background-color become dark
+CSS_COLOR_RE = re.compile(r'(background-color|background|color)\s*:[^;}]+')
+DARK_BACKGROUND_COLOR = '#2F2F2F'
+
+
+def dark_theme_css(css, text_color):
+    def replace(m):
+        prop = m.group(1)
+        return '%s:%s' % (prop, DARK_BACKGROUND_COLOR if prop.startswith('background') else text_color)
+    return CSS_COLOR_RE.sub(replace, css)
@@ -0,0 +1,139 @@
+import html
+import re
+from urllib.parse import quote
+
+# Single pass over mdx definition markup, only start tags we care about are
+# touched, everything else is copied through unchanged.
+
+# As in html.parser a value is quoted only when it starts with a quote, an
+# unquoted value runs up to whitespace or > and may contain quotes itself.
+ATTR_VALUE = r'"[^"]*"|\'[^\']*\'|(?![\'"])[^\s>]*(?![^\s>])'
+TOKEN_RE = re.compile(
+    r'<!--.*?(?:-->|\Z)'
+    r'|<([a-zA-Z][^\s/>]*(?![^\s/>]))((?:[\s/]+(?![\s/])|[^\s/>=]+(?![^\s/>=])(?:\s*=\s*(?!\s)(?:' + ATTR_VALUE + r')|(?!\s*=))|=[^\s>]*(?![^\s>]))*)>',
+    re.DOTALL)
+ATTR_RE = re.compile(
+    r'([^\s"\'=<>/]+)(?:(\s*=\s*)(' + ATTR_VALUE + r'))?')
+RAWTEXT_END_RE = {
+    'script': re.compile(r'</script\s*>', re.IGNORECASE),
+    'style': re.compile(r'</style\s*>', re.IGNORECASE),
+}
+
+RESOURCE_ATTRS = {
+    'link': 'href',
+    'script': 'src',
+    'img': 'src',
+}
+TRAILING_SLASH_RE = re.compile(r'/+$')
+
+
+def resource_url(dicname_quote, res_id, base='', version=None):
+    url = '%sresources?dic=%s&id=%s' % (base, dicname_quote, quote(res_id))
+    if version is not None:
+        url += '&v=%s' % version
+    return url
+
+
+def entry_url(href, base=''):
+    href = href.replace('entry://#', '#')
+    href = href.replace('entry://', base + 'lookup?word=')
+    return TRAILING_SLASH_RE.sub('', href)
+
+
+def attr_value(raw):
+    if raw is None:
+        return ''
+    if raw[:1] in ('"', "'"):
+        raw = raw[1:-1]
+    return html.unescape(raw)
+
+
+def find_attr(attrs, name):
+    for m in ATTR_RE.finditer(attrs):
+        if m.group(1).lower() == name:
+            return attr_value(m.group(3))
+    return None
+
+
+def rewrite_attrs(attrs, name, func):
+    out = []
+    pos = 0
+    for m in ATTR_RE.finditer(attrs):
+        if m.group(1).lower() != name:
+            continue
+        value = func(attr_value(m.group(3)))
+        out.append(attrs[pos:m.start()])
+        out.append('%s="%s"' % (m.group(1), html.escape(value, quote=True)))
+        pos = m.end()
+    if not out:
+        return attrs
+    out.append(attrs[pos:])
+    return ''.join(out)
+
+
+def rewrite_definition(content, dicname_quote, text_color=None, base='', version=None, resources=None, inline=None):
+    '''
+    resources, if given, is a list extended with the ids of the stylesheets,
+    scripts and images the rewritten definition refers to.
+
+    inline, if given, is called as inline(tag, res_id) for images and
+    stylesheets and returns a data: url for an img, the css text for a
+    link, or None to keep referring to the resource.
+    '''
+    def resource_ref(res_id):
+        if resources is not None:
+            resources.append(res_id)
+        return resource_url(dicname_quote, res_id, base, version)
+
+    out = []
+    pos = 0
+    length = len(content)
+    # no tag can end after the last >, nothing past it is tried as one, so
+    # unclosed tags do not have every < rescan the rest of the text
+    last = content.rfind('>') + 1
+    while pos < last:
+        m = TOKEN_RE.search(content, pos, last)
+        if m is None:
+            break
+        tag = m.group(1)
+        if tag is None:     # comment
+            out.append(content[pos:m.end()])
+            pos = m.end()
+            continue
+        tag = tag.lower()
+        attrs = m.group(2)
+        if tag == 'link' and inline is not None:
+            href = find_attr(attrs, 'href')
+            css = inline(tag, href) if href and href.lower().endswith('.css') else None
+            if css is not None:
+                out.append(content[pos:m.start()])
+                out.append('<style>%s</style>' % css.replace('</', '<\\/'))
+                pos = m.end()
+                continue
+            attrs = rewrite_attrs(attrs, 'href', resource_ref)
+        elif tag == 'img' and inline is not None:
+            attrs = rewrite_attrs(attrs, 'src', lambda v: inline(tag, v) or resource_ref(v))
+        elif tag in RESOURCE_ATTRS:
+            attrs = rewrite_attrs(attrs, RESOURCE_ATTRS[tag], resource_ref)
+        elif tag == 'a':
+            sound = []
+            def link_url(href):
+                if href.startswith('sound://'):     # played by mdict.js from the resources endpoint
+                    sound.append(href)
+                    return resource_url(dicname_quote, href[len('sound://'):], base, version)
+                return entry_url(href, base)
+            attrs = rewrite_attrs(attrs, 'href', link_url)
+            if sound:
+                attrs = ' data-mdict-sound="1"' + attrs
+        elif tag == 'font' and text_color:
+            attrs = rewrite_attrs(attrs, 'color', lambda v: text_color)
+        out.append(content[pos:m.start()])
+        out.append('<%s%s>' % (m.group(1), attrs))
+        pos = m.end()
+        if tag in RAWTEXT_END_RE and not attrs.rstrip().endswith('/'):
+            end = RAWTEXT_END_RE[tag].search(content, pos)
+            end = end.start() if end else length
+            out.append(content[pos:end])
+            pos = end
+    out.append(content[pos:])
+    return ''.join(out)
@@ -1,125 +1,88 @@
+import base64
 import os
+import time
 
 from calibre.srv.routes import endpoint, json
+from calibre.srv.errors import HTTPNotFound
 
 from calibre.customize.ui import find_plugin
 
-import bs4
 from urllib.parse import (quote, unquote)
 import html
 
-import re
-
 import calibre_plugins.dsreader_helper.config as cfg
+from calibre_plugins.dsreader_helper.srv.dict_cache import (lookup_cache, resource_cache, css_cache, inline_cache, cache_stats)
+from calibre_plugins.dsreader_helper.srv.dict_rewriter import rewrite_definition
+from calibre_plugins.dsreader_helper.srv.dict_lookup import (fan_out, RESULT_OK, RESULT_TIMEOUT)
+from calibre_plugins.dsreader_helper.srv.dict_prefetch import PrefetchQueue
+from calibre_plugins.dsreader_helper.srv.dict_loader import (dict_loader, dict_watcher)
+from calibre_plugins.dsreader_helper.srv.dict_governor import (collect, memory_info)
+from calibre_plugins.dsreader_helper.srv.dict_index import (queued_headword_index, index_queue, merged_prefixed, prefixed_keys, similar_words)
+from calibre_plugins.dsreader_helper.srv.dict_resources import (resource_etag, etag_matches, resource_content_type, parse_range, dark_theme_css, CACHE_CONTROL_IMMUTABLE)
 from polyglot.urllib import unquote
 
 import traceback
+import http.client as http_client
+
+HINT_LIMIT_MAX = 1000
 
 @endpoint('/dshelper/dict_viewer/{req_type}', types={'req_type': str}, auth_required=False)
 def dshelper_dict_viewer(ctx, rd, req_type):
     #traceback.print_stack()
 
     print('dshelper_dict_viewer ctx=%s rd=%s cookies=%s req_type=%s ' % (str(ctx), str(rd), str(rd.cookies), str(req_type)))
+    collect()   # unloads idle dictionaries over the memory budget, at most every so often
 
     if req_type == 'lookup':
         word = rd.query.get('word', None)
         if word is None:
             return b'missing word='
 
-        dictresult = []
-        result = ''
-        print('dshelper_dict_viewer word %s' % word)
-        print('dshelper_dict_viewer builders %s' % str(cfg.dict_builders))
-
         c = cfg.plugin_prefs[cfg.STORE_NAME]
-        library_dict_ordered_list = c.get(cfg.KEY_DICT_VIEWER_ORDERED_LIST, {})
-        dict_library_name = c.get(cfg.KEY_DICT_VIEWER_LIBRARY_NAME, '')
-        dict_ordered_list = library_dict_ordered_list.get(dict_library_name, [])
-        for dict_entry in dict_ordered_list:
-            dicname = '%d#%s' % (dict_entry['id'], dict_entry['mdx'])
-            if dicname not in cfg.dict_builders:
-                continue
-            dicname_quote = quote(dicname)
-            builder = cfg.dict_builders[dicname].get('builder', None)
-            if not builder:
-                continue
-            print('dshelper_dict_viewer builder %s' % str(builder))
-            contents = builder.mdx_lookup(word, ignorecase=True)
-            for content in contents:
-                dict_soup = bs4.BeautifulSoup(content, 'html.parser')
-                for link in dict_soup.find_all('link'):
-                    if link.has_attr('href'):
-                        link_href = link['href']
-                        link_href_quote = quote(link_href)
-                        link['href'] = 'resources?dic=%s&id=%s' % (dicname_quote, link_href_quote)
-                for script in dict_soup.find_all('script'):
-                    if script.has_attr('src'):
-                        script_src = script['src']
-                        script_src_quote = quote(script_src)
-                        script['src'] = 'resources?dic=%s&id=%s' % (dicname_quote, script_src_quote)
-                for img in dict_soup.find_all('img'):
-                    if img.has_attr('src'):
-                        img_src = img['src']
-                        img_src_quote = quote(img_src)
-                        img['src'] = 'resources?dic=%s&id=%s' % (dicname_quote, img_src_quote)
-                for a in dict_soup.find_all('a'):
-                    if a.has_attr('href'):
-                        a_href = a['href']
-                        a_href = a_href.replace('entry://#', '#')
-                        a_href = a_href.replace('entry://', 'lookup?word=')
-                        a_href = re.sub(r'/+$', r'', a_href)
-                        a['href'] = a_href
-                if rd.cookies.get('textColor', '#') != '#':
-                    textColor = rd.cookies["textColor"]
-                    for f in dict_soup.find_all('font'):
-                        if f.has_attr('color'):
-                            f['color'] = textColor
-
-                # print(dict_soup.prettify())
-
-                segment = dict_soup.prettify()
-                dictresult.append(
-                    '<div class="mdictDefinition" id="mdictDefinition' + str(len(dictresult)) + '">' + 
-                    '<h5>' + cfg.dict_builders[dicname]['title'] + "</h5>" +
-                    segment +
-                    '</div>'
-                )
+        loading = dict_loader.not_ready()
+        if loading:     # give the dictionaries still loading a moment, then leave them out
+            dict_loader.wait_ready([dicname for dicname, _ in loading], float(c.get(cfg.KEY_DICT_VIEWER_LOADING_WAIT, cfg.DEFAULT_STORE_VALUES[cfg.KEY_DICT_VIEWER_LOADING_WAIT])))
+            loading = dict_loader.not_ready()
 
-            words = list(filter(lambda w: w.lower() != word, builder.get_mdx_keys(word)))
-            if words:
-                if len(words) > 10:
-                    words = words[0:10]
-                links=list(map(lambda w: '<p><a href="lookup?word=%s">%s</a></p>' % (quote(w),html.escape(w)), words))
-                dictresult.append(
-                    '<div class="mdictSimilar" id="mdictSimilar' + str(len(dictresult)) + '">' + 
-                    '<h6>Similar Words</h6>' +
-                    '\n'.join(links) +
-                    '</div>'
-                )
-        
-        if not dictresult:
-            dictresult.append('<p>Found no result</p>')
+        registry = cfg.dict_registry
+        print('dshelper_dict_viewer word %s generation %d' % (word, registry.generation))
 
-        try:
-            header = '<html><head>\
-                <meta name="viewport" content="width=device-width, initial-scale=1, shrink-to-fit=no">\
-                <style>h5 { text-align: center; }</style>'
-            header += '<style id="style_folio_font">.mdictDefinition { font-family: sans-serif; font-size: 120%; line-height: 150%; }</style>'
-            if 'backgroundColor' in rd.cookies:
-                header += '<style id="style_folio_background">html body { background-color: %s !important; }</style>' % rd.cookies['backgroundColor']
-            if rd.cookies.get('textColor', '#') != '#':
-                header += '<style id="style_folio_text">html body { color: %s !important; }</style>' % rd.cookies['textColor']
-            header += '</head><body>'
-            dictresult.insert(0, header)
-            # dictresult.insert(1, '<script src="resources?dic=static&id=mdict.js"></script>')
-
-            dictresult.append('</body></html>')
-            result = '<hr />\n'.join(dictresult)
-            # print('dshelper_dict_viewer result %s' % str(result))
-        except BaseException as e:
-            print('dshelper_dict_viewer except %s' % str(e))
+        client_theme = dshelper_dict_client_theme()
+        cookies = {} if client_theme else rd.cookies
+
+        similar_limit = int(c.get(cfg.KEY_DICT_VIEWER_SIMILAR_LIMIT, cfg.DEFAULT_STORE_VALUES[cfg.KEY_DICT_VIEWER_SIMILAR_LIMIT]))
+        similar_ranked = c.get(cfg.KEY_DICT_VIEWER_SIMILAR_RANKED, cfg.DEFAULT_STORE_VALUES[cfg.KEY_DICT_VIEWER_SIMILAR_RANKED])
+        if rd.query.get('similar', '1') in ('0', 'false'):
+            similar_limit = 0
 
+        # ?inline=1 / 0 for all dictionaries, otherwise the dictionaries chosen in the settings
+        inline = rd.query.get('inline', None)
+        if inline is not None:
+            inline = inline not in ('0', 'false')
+
+        cache_key = (
+            word,
+            similar_limit, similar_ranked,
+            inline,
+            registry.generation,
+            cookies.get('textColor', '#'),
+            cookies.get('backgroundColor', None)
+        )
+        cached = lookup_cache().get(cache_key)
         rd.outheaders.set('Content-Type', 'text/html; charset=UTF-8', replace_all=True)
+        if cached is not None:
+            return cached
+
+        text_color = None
+        if cookies.get('textColor', '#') != '#':
+            text_color = cookies['textColor']
+
+        state = {}
+        chunks = dshelper_dict_lookup_chunks(word, registry.entries, dshelper_dict_versions(registry), text_color, cookies, client_theme, similar_limit, similar_ranked, inline, loading, state)
+
+        result = b''.join(chunks)
+        if state.get('complete', False):
+            lookup_cache().put(cache_key, result)
 
         return result
 
@@ -133,47 +96,66 @@ def dshelper_dict_viewer(ctx, rd, req_type):
         req_id_unquote = unquote(req_id)
 
         if req_dic_unquote == 'static':
-            zip_path = os.path.dirname(cfg.__file__)
-            res_path = 'static/' + req_id_unquote
-            from zipfile import ZipFile
-            print('dshelper_dict_viewer resources static %s' % res_path)
-            with ZipFile(zip_path, 'r') as myzip:
-                with myzip.open(res_path, 'r') as file:
-                    data = file.read()
-                    return dshelper_dict_resource_process(rd, data, res_path)
+            asset = ctx.static_assets.get(req_id_unquote, None)
+            if asset is None:
+                raise HTTPNotFound('no static resource %s' % req_id_unquote)
+            rd.outheaders.set('Cache-Control', 'no-cache', replace_all=True)
+            return rd.etagged_dynamic_response(asset.etag, lambda: asset.data, asset.content_type)
 
         print('dshelper_dict_viewer resources mdd dic=%s id=%s' % (req_dic_unquote, req_id_unquote))
-    
-        if req_dic_unquote in cfg.dict_builders:
-            res_path = os.path.join(cfg.dict_builders[req_dic_unquote]['basepath'], req_id_unquote)
-            print('dshelper_dict_viewer resources res_path=%s' % res_path)
-        
-            try:
-                if os.path.exists(res_path):
-                    with open(res_path, 'rb') as file:  #read data as bytes
-                        data = file.read()
-                        return dshelper_dict_resource_process(rd, data, res_path)
-            except:
-                pass
-
-            print('dshelper_dict_viewer resources notexist res_path=%s' % res_path)
-        
-            builder = cfg.dict_builders[req_dic_unquote]['builder']
-            print('dshelper_dict_viewer resources notexist builder=%s' % str(builder))
-
-            try:
-                if req_id_unquote.startswith("file://"):
-                    req_id_unquote = req_id_unquote[7:]
-                    print('dshelper_dict_viewer resources mdd req_id_unquote=%s' % (req_id_unquote))
-
-                res_path = '\\%s' % '\\'.join(req_id_unquote.strip('/').split('/'))   # according to flask-mdict
-                print('dshelper_dict_viewer resources mdd res_path=%s' % (res_path))
-                datum = builder.mdd_lookup(res_path, ignorecase=True)
-                for data in datum:      #data is bytes
-                    return dshelper_dict_resource_process(rd, data, res_path)
-            except Exception as e:
-                print("dshelper_dict_viewer exception %s" % str(e))
-                traceback.print_exc()
+
+        registry = cfg.dict_registry
+        dict_info = registry.get(req_dic_unquote)
+        if not dict_info:
+            raise HTTPNotFound('no dictionary %s' % req_dic_unquote)
+
+        theme_variant = None
+        if req_id_unquote.endswith('.css') and not dshelper_dict_client_theme():
+            theme_variant = rd.cookies.get('textColor', '#')
+        # the version changes with the dictionary's file, across restarts as well
+        version = dict_info.get('version', None)
+        etag = resource_etag(version, req_dic_unquote, req_id_unquote, theme_variant)
+        if theme_variant is not None:   # same url, content depends on the theme cookie
+            rd.outheaders.set('Cache-Control', 'no-cache', replace_all=True)
+            rd.outheaders.set('Vary', 'Cookie', replace_all=True)
+        elif version is not None and rd.query.get('v', None) == version:
+            rd.outheaders.set('Cache-Control', CACHE_CONTROL_IMMUTABLE, replace_all=True)
+        else:   # unversioned url, revalidated with the etag
+            rd.outheaders.set('Cache-Control', 'no-cache', replace_all=True)
+        if etag_matches(rd, etag):
+            # answered with 304 by calibre, the resource itself is never looked up
+            return rd.etagged_dynamic_response(etag, lambda: b'')
+
+        if theme_variant in (None, '#'):
+            output = dshelper_dict_resource_open(dict_info, req_id_unquote)
+            if output is not None:
+                # served by calibre straight from the file: sendfile where
+                # possible, ranges and If-None-Match handled there as well
+                head = output.read(16)
+                output.seek(0)
+                rd.outheaders.set('Content-Type', resource_content_type(output.name, head), replace_all=True)
+                return rd.filesystem_file_with_constant_etag(output, etag.strip('"'))
+
+        data, res_path = dshelper_dict_resource_load(req_dic_unquote, dict_info, req_id_unquote)
+        if data is None:
+            rd.outheaders.pop('Cache-Control', all=True)
+            raise HTTPNotFound('no resource %s in %s' % (req_id_unquote, req_dic_unquote))
+        data = dshelper_dict_resource_process(rd, req_dic_unquote, data, res_path)
+
+        # audio players fetch pronunciations in pieces, slices come from the cached blob
+        rd.outheaders.set('Accept-Ranges', 'bytes', replace_all=True)
+        byte_range = parse_range(rd, len(data), etag)
+        if byte_range is False:
+            rd.status_code = http_client.REQUESTED_RANGE_NOT_SATISFIABLE
+            rd.outheaders.pop('Cache-Control', all=True)
+            rd.outheaders.set('Content-Range', 'bytes */%d' % len(data), replace_all=True)
+            return b''
+        if byte_range:
+            start, stop = byte_range
+            rd.status_code = http_client.PARTIAL_CONTENT
+            rd.outheaders.set('Content-Range', 'bytes %d-%d/%d' % (start, stop - 1, len(data)), replace_all=True)
+            data = data[start:stop]
+        return rd.etagged_dynamic_response(etag, lambda: data)
 
     if req_type == 'hint':
         rd.outheaders.set('Content-Type', 'application/json; charset=UTF-8', replace_all=True)
@@ -182,55 +164,407 @@ def dshelper_dict_viewer(ctx, rd, req_type):
             return b'missing word='
         
         result = {}
-        print('dshelper_dict_viewer word %s' % word)
-        print('dshelper_dict_viewer builders %s' % str(cfg.dict_builders))
+        registry = cfg.dict_registry
+        print('dshelper_dict_viewer word %s generation %d' % (word, registry.generation))
 
         c = cfg.plugin_prefs[cfg.STORE_NAME]
-        library_dict_ordered_list = c.get(cfg.KEY_DICT_VIEWER_ORDERED_LIST, {})
-        dict_library_name = c.get(cfg.KEY_DICT_VIEWER_LIBRARY_NAME, '')
-        dict_ordered_list = library_dict_ordered_list.get(dict_library_name, [])
-        for dict_entry in dict_ordered_list:
-            dicname = '%d#%s' % (dict_entry['id'], dict_entry['mdx'])
-            if dicname not in cfg.dict_builders:
-                continue
-            dicname_quote = quote(dicname)
-            builder = cfg.dict_builders[dicname].get('builder', None)
-            if not builder:
-                continue
-            print('dshelper_dict_viewer builder %s' % str(builder))
 
-            # words = list(filter(lambda w: w.lower() != word, builder.get_mdx_keys(word)))
-            # result += list(map(lambda w: w.lower(), words))
-            for hint in builder.get_mdx_keys(word):
-                print('dshelper_dict_viewer hint %s %s %s' % (word, hint, cfg.dict_builders[dicname]['title'], ))
+        try:
+            limit = int(rd.query.get('limit', c.get(cfg.KEY_DICT_VIEWER_HINT_LIMIT, cfg.DEFAULT_STORE_VALUES[cfg.KEY_DICT_VIEWER_HINT_LIMIT])))
+        except ValueError:
+            limit = cfg.DEFAULT_STORE_VALUES[cfg.KEY_DICT_VIEWER_HINT_LIMIT]
+        limit = max(1, min(limit, HINT_LIMIT_MAX))     # a negative LIMIT is no limit to sqlite
+
+        skipped = []
+        unindexed = registry.entries
+        if '*' not in word and c.get(cfg.KEY_DICT_VIEWER_HINT_INDEX, cfg.DEFAULT_STORE_VALUES[cfg.KEY_DICT_VIEWER_HINT_INDEX]):
+            # indexes are loaded on the index thread, dictionaries without
+            # one yet are asked with a bounded prefix query meanwhile
+            indexes = []
+            unindexed = []
+            for item in registry.entries:
+                index = queued_headword_index(item[2])
+                if index is None:
+                    unindexed.append(item)
+                else:
+                    indexes.append(index)
+            result = merged_prefixed(indexes, word, limit)
+        for (_, title, builder, _), status, hints in fan_out(lambda item: prefixed_keys(item[2], word, limit), unindexed):
+            if status != RESULT_OK:
+                skipped.append(title)
+                continue
+            for hint in hints:
+                if hint not in result and len(result) >= limit:
+                    continue
                 result[hint] = result.get(hint, 0) + 1
         from calibre.utils.serialize import json_dumps
-        return json_dumps({'prefixed': result})
+        return json_dumps({'prefixed': result, 'skipped': skipped})
+
+    if req_type == 'loading':
+        rd.outheaders.set('Content-Type', 'application/json; charset=UTF-8', replace_all=True)
+        from calibre.utils.serialize import json_dumps
+        return json_dumps(dict(dict_loader.info(), watcher=dict_watcher.info()))
+
+    if req_type == 'memory':
+        rd.outheaders.set('Content-Type', 'application/json; charset=UTF-8', replace_all=True)
+        from calibre.utils.serialize import json_dumps
+        if rd.query.get('collect', '0') not in ('0', 'false'):
+            collect(force=True)
+        return json_dumps(memory_info())
+
+    if req_type == 'stats':
+        rd.outheaders.set('Content-Type', 'application/json; charset=UTF-8', replace_all=True)
+        from calibre.utils.serialize import json_dumps
+        return json_dumps({'caches': cache_stats(), 'prefetch': resource_prefetch.stats(), 'index': index_queue.stats()})
+
+@endpoint('/dshelper/dict_viewer_batch', methods={'POST'}, auth_required=False)
+def dshelper_dict_viewer_batch(ctx, rd):
+    from calibre.utils.serialize import json_loads
+    try:
+        req = json_loads(rd.request_body_file.read())
+    except ValueError:
+        return b'invalid json'
+    if isinstance(req, dict):
+        req = req.get('words', None)
+    if not isinstance(req, list):
+        return b'missing words'
+
+    words = []
+    seen = set()
+    for word in req:
+        if not isinstance(word, str):
+            continue
+        word = word.strip()
+        if word and word not in seen:
+            seen.add(word)
+            words.append(word)
+    print('dshelper_dict_viewer_batch %d words' % len(words))
+
+    c = cfg.plugin_prefs[cfg.STORE_NAME]
+    registry = cfg.dict_registry
+
+    # links in definitions are resolved against the dict_viewer endpoint
+    base = ctx.url_for('/dshelper/dict_viewer', req_type='lookup').rpartition('/')[0] + '/'
+    max_size = int(c.get(cfg.KEY_DICT_VIEWER_BATCH_MAX_SIZE, cfg.DEFAULT_STORE_VALUES[cfg.KEY_DICT_VIEWER_BATCH_MAX_SIZE])) * 1024 * 1024
+    max_words = int(c.get(cfg.KEY_DICT_VIEWER_BATCH_MAX_WORDS, cfg.DEFAULT_STORE_VALUES[cfg.KEY_DICT_VIEWER_BATCH_MAX_WORDS]))
+    timeout = float(c.get(cfg.KEY_DICT_VIEWER_BATCH_TIMEOUT, cfg.DEFAULT_STORE_VALUES[cfg.KEY_DICT_VIEWER_BATCH_TIMEOUT]))
+
+    rd.outheaders.set('Content-Type', 'application/json; charset=UTF-8', replace_all=True)
+    # looked up here in the request thread, a generator would be run on calibre's event loop
+    return dshelper_dict_batch(words, registry.entries, dshelper_dict_versions(registry), base, max_size, max_words, timeout)
+
+BATCH_CHUNK_WORDS = 16
+
+def dshelper_dict_batch(words, dict_items, versions, base, max_size, max_words, timeout):
+    '''
+    JSON of the definitions of words in every dictionary. The words are
+    looked up BATCH_CHUNK_WORDS at a time, each chunk is one bounded fan_out
+    task per dictionary. Lookups stop at max_words, after timeout seconds or
+    once the definitions fill max_size bytes, the answer is then truncated.
+    '''
+    from calibre.utils.serialize import json_dumps as dumps
+    deadline = time.monotonic() + timeout
+    truncated = len(words) > max_words
+    words = words[:max_words]
+    dict_items = list(dict_items)
+    skipped = []
+    parts = []
+    size = 0
+    full = False
+    for start in range(0, len(words), BATCH_CHUNK_WORDS):
+        if not dict_items:
+            break
+        if time.monotonic() >= deadline:
+            truncated = True
+            break
+        chunk_words = words[start:start + BATCH_CHUNK_WORDS]
+
+        def lookup_words(item):
+            dicname_quote, title, builder, dicname = item
+            found = {}
+            for word in chunk_words:
+                contents = builder.mdx_lookup(word, ignorecase=True)
+                if contents:
+                    found[word] = [rewrite_definition(content, dicname_quote, None, base, versions.get(dicname, None)) for content in contents]
+            return found
+
+        definitions = {}
+        answered = []
+        for item, status, found in fan_out(lookup_words, dict_items, key=lambda item: item[3]):
+            if status != RESULT_OK:
+                skipped.append(item[3])     # not asked again for the following words
+                continue
+            answered.append(item)
+            for word, contents in found.items():
+                definitions.setdefault(word, {})[item[3]] = contents
+        dict_items = answered
+
+        for word in chunk_words:
+            if word not in definitions:
+                continue
+            part = (b',' if parts else b'') + dumps(word) + b':' + dumps(definitions[word])
+            if size + len(part) > max_size:
+                truncated = full = True
+                break
+            size += len(part)
+            parts.append(part)
+        if full:
+            break
+
+    dictionaries = dict((dicname, title) for _, title, _, dicname in dict_items)
+    return (b'{"dictionaries":' + dumps(dictionaries) + b',"skipped":' + dumps(skipped) +
+            b',"definitions":{' + b''.join(parts) + b'},"truncated":' + dumps(truncated) + b'}')
+
+def dshelper_dict_versions(registry):
+    # dicname -> version put into resource urls as v=
+    return dict((dicname, info.get('version', None)) for dicname, info in registry.builders.items())
+
+def dshelper_dict_client_theme():
+    c = cfg.plugin_prefs[cfg.STORE_NAME]
+    return c.get(cfg.KEY_DICT_VIEWER_CLIENT_THEME, cfg.DEFAULT_STORE_VALUES[cfg.KEY_DICT_VIEWER_CLIENT_THEME])
+
+def dshelper_dict_lookup_chunks(word, dict_items, versions, text_color, cookies, client_theme, similar_limit, similar_ranked, inline, loading, state):
+    header = '<html data-mdict-theme="client"><head>' if client_theme else '<html><head>'
+    header += '\
+        <meta name="viewport" content="width=device-width, initial-scale=1, shrink-to-fit=no">\
+        <style>h5 { text-align: center; }</style>'
+    header += '<style id="style_folio_font">.mdictDefinition { font-family: sans-serif; font-size: 120%; line-height: 150%; }</style>'
+    if 'backgroundColor' in cookies:
+        header += '<style id="style_folio_background">html body { background-color: %s !important; }</style>' % cookies['backgroundColor']
+    if text_color:
+        header += '<style id="style_folio_text">html body { color: %s !important; }</style>' % text_color
+    if client_theme:    # colours are applied by mdict.js from the reader's cookies
+        header += '<style id="style_folio_theme">\
+            html.mdict-background body { background-color: var(--mdict-background-color) !important; }\
+            html.mdict-text body, html.mdict-text font[color] { color: var(--mdict-text-color) !important; }</style>'
+    header += '<script src="resources?dic=static&id=mdict.js"></script>'   #sound links, client theme
+    header += '</head><body>'
+    yield header.encode('utf-8')
+
+    c = cfg.plugin_prefs[cfg.STORE_NAME]
+    prefetch = c.get(cfg.KEY_DICT_VIEWER_PREFETCH, cfg.DEFAULT_STORE_VALUES[cfg.KEY_DICT_VIEWER_PREFETCH])
+    inline_dictionaries = c.get(cfg.KEY_DICT_VIEWER_INLINE_DICTIONARIES, cfg.DEFAULT_STORE_VALUES[cfg.KEY_DICT_VIEWER_INLINE_DICTIONARIES])
+    inline_max_size = int(c.get(cfg.KEY_DICT_VIEWER_INLINE_MAX_SIZE, cfg.DEFAULT_STORE_VALUES[cfg.KEY_DICT_VIEWER_INLINE_MAX_SIZE])) * 1024
+
+    def lookup_word(item):
+        dicname_quote, title, builder, dicname = item
+        inliner = None
+        if inline or (inline is None and dicname in inline_dictionaries):
+            inliner = lambda tag, res_id: dshelper_dict_inline(dicname, res_id, tag, text_color, inline_max_size)
+        return dshelper_dict_lookup_word(builder, word, dicname_quote, versions.get(dicname, None), text_color, similar_limit, similar_ranked, inliner)
+
+    count = 0
+    complete = True
+    for (dicname_quote, title, builder, dicname), status, lookup_result in fan_out(lookup_word, dict_items):
+        dictresult = []
+        if status != RESULT_OK:
+            complete = False
+            dictresult.append(
+                '<div class="mdictSkipped" id="mdictSkipped' + str(count) + '">' +
+                '<h5>' + title + '</h5>' +
+                '<p>' + ('Timed out' if status == RESULT_TIMEOUT else 'Failed') + '</p>' +
+                '</div>'
+            )
+        else:
+            segments, words, resources = lookup_result
+            if prefetch:
+                dshelper_dict_prefetch_resources(dicname, resources)
+            for segment in segments:
+                dictresult.append(
+                    '<div class="mdictDefinition" id="mdictDefinition' + str(count + len(dictresult)) + '">' + 
+                    '<h5>' + title + "</h5>" +
+                    segment +
+                    '</div>'
+                )
+
+            if words:
+                links=list(map(lambda w: '<p><a href="lookup?word=%s">%s</a></p>' % (quote(w),html.escape(w)), words))
+                dictresult.append(
+                    '<div class="mdictSimilar" id="mdictSimilar' + str(count + len(dictresult)) + '">' + 
+                    '<h6>Similar Words</h6>' +
+                    '\n'.join(links) +
+                    '</div>'
+                )
+        if dictresult:
+            count += len(dictresult)
+            yield ''.join('<hr />\n' + block for block in dictresult).encode('utf-8')
+
+    ready = set(item[3] for item in dict_items)
+    loading = [title for dicname, title in loading if dicname not in ready]
+    if loading:
+        complete = False
+        yield ''.join(
+            '<hr />\n<div class="mdictSkipped" id="mdictSkipped' + str(count + i) + '">' +
+            '<h5>' + title + '</h5>' +
+            '<p>Loading</p>' +
+            '</div>' for i, title in enumerate(loading)).encode('utf-8')
+        count += len(loading)
+
+    if not count:
+        yield '<hr />\n<p>Found no result</p>'.encode('utf-8')
+
+    yield '<hr />\n</body></html>'.encode('utf-8')
+    state['complete'] = complete
+
+def dshelper_dict_lookup_word(builder, word, dicname_quote, version, text_color, similar_limit, similar_ranked, inline=None):
+    resources = []
+    segments = [rewrite_definition(content, dicname_quote, text_color, version=version, resources=resources, inline=inline) for content in builder.mdx_lookup(word, ignorecase=True)]
+    words = similar_words(builder, word, similar_limit, similar_ranked)
+    return segments, words, resources
+
+def dshelper_dict_prefetch_resources(dicname, resources):
+    for res_id in resources:
+        if res_id.startswith('data:') or ('://' in res_id and not res_id.startswith('file://')):
+            continue
+        resource_prefetch.put((dicname, res_id))
+
+def dshelper_dict_prefetch(key):
+    # runs on the prefetch thread, the browser finds the mdd resource in the cache
+    dicname, res_id = key
+    dict_info = cfg.dict_registry.get(dicname)
+    if not dict_info or dshelper_dict_resource_path(dict_info, res_id) is not None:
+        return  # gone, or served from disk
+    dshelper_dict_resource_load(dicname, dict_info, res_id)
+
+resource_prefetch = PrefetchQueue('resource', dshelper_dict_prefetch)
+
+INLINE_NOT_AVAILABLE = ''
+INLINE_NOT_AVAILABLE_COST = 256
+
+def dshelper_dict_inline(dicname, res_id, tag, text_color, max_size):
+    '''
+    data: url of an image or text of a stylesheet no larger than max_size,
+    None when the resource is missing or too large to be put in the page
+    '''
+    if tag != 'link':
+        text_color = None   # only stylesheets depend on the theme
+    cache = inline_cache()
+    cache_key = (dicname, res_id, text_color)
+    encoded = cache.get(cache_key)
+    if encoded is not None:
+        return encoded or None
+
+    encoded = INLINE_NOT_AVAILABLE
+    dict_info = cfg.dict_registry.get(dicname)
+    if dict_info:
+        res_path = dshelper_dict_resource_path(dict_info, res_id)
+        if res_path is None or os.path.getsize(res_path) <= max_size:
+            data, res_path = dshelper_dict_resource_load(dicname, dict_info, res_id)
+            if data is not None and len(data) <= max_size:
+                if tag == 'link':
+                    encoded = data.decode('UTF-8', 'replace')
+                    if text_color:
+                        encoded = dark_theme_css(encoded, text_color)
+                else:
+                    encoded = 'data:%s;base64,%s' % (resource_content_type(res_path, data), base64.b64encode(data).decode('ascii'))
+
+    cache.put(cache_key, encoded, len(encoded) or INLINE_NOT_AVAILABLE_COST)
+    return encoded or None
+
+def dshelper_dict_resource_path(dict_info, req_id_unquote):
+    basepath = os.path.abspath(dict_info['basepath'])
+    res_path = os.path.abspath(os.path.join(basepath, req_id_unquote))
+    if not res_path.startswith(basepath + os.sep):     # no way out of the dictionary folder
+        return None
+    if not os.path.isfile(res_path):
+        print('dshelper_dict_viewer resources notexist res_path=%s' % res_path)
+        return None
+    return res_path
+
+def dshelper_dict_resource_open(dict_info, req_id_unquote):
+    res_path = dshelper_dict_resource_path(dict_info, req_id_unquote)
+    if res_path is None:
+        return None
+    try:
+        return open(res_path, 'rb')
+    except OSError:
+        return None
+
+def dshelper_dict_resource_load(dicname, dict_info, req_id_unquote):
+    res_path = dshelper_dict_resource_path(dict_info, req_id_unquote)
+    print('dshelper_dict_viewer resources res_path=%s' % res_path)
+
+    if res_path is not None:
+        try:
+            with open(res_path, 'rb') as file:  #read data as bytes
+                return file.read(), res_path
+        except OSError:
+            pass
+
+    zipfs = dict_info.get('zip', None)
+    if zipfs is not None:
+        data, res_path = dshelper_dict_zip_lookup(dicname, zipfs, req_id_unquote)
+        if data is not None:
+            return data, res_path
+
+    return dshelper_dict_mdd_lookup(dicname, dict_info['builder'], req_id_unquote)
+
+def dshelper_dict_zip_lookup(dicname, zipfs, req_id_unquote):
+    info = zipfs.find(req_id_unquote)
+    if info is None:
+        return None, req_id_unquote
+    cache = resource_cache()
+    cache_key = (dicname, 'zip:' + info.filename.lower())
+    data = cache.get(cache_key)
+    if data is None:
+        try:
+            data = zipfs.read(info)     # None once the zip was replaced
+        except Exception as e:
+            print("dshelper_dict_viewer zip exception %s %s" % (info.filename, str(e)))
+            return None, info.filename
+        if data is not None:
+            cache.put(cache_key, data)
+    return data, info.filename
+
+def dshelper_dict_mdd_lookup(dicname, builder, req_id_unquote):
+    if req_id_unquote.startswith("file://"):
+        req_id_unquote = req_id_unquote[7:]
+
+    res_path = '\\%s' % '\\'.join(req_id_unquote.strip('/').split('/'))   # according to flask-mdict
+    cache = resource_cache()
+    cache_key = (dicname, res_path.lower())     #mdd_lookup ignores case
+    data = cache.get(cache_key)
+    if data is cache.NOT_FOUND:
+        return None, res_path
+    if data is not None:
+        return data, res_path
+
+    print('dshelper_dict_viewer resources mdd builder=%s res_path=%s' % (str(builder), res_path))
+    try:
+        datum = builder.mdd_lookup(res_path, ignorecase=True)
+        for data in datum:      #data is bytes
+            cache.put(cache_key, data)
+            return data, res_path
+    except Exception as e:
+        print("dshelper_dict_viewer exception %s" % str(e))
+        traceback.print_exc()
+        return None, res_path
+
+    cache.put_not_found(cache_key)
+    return None, res_path
 
 #data in bytes
-def dshelper_dict_resource_process(rd, data, res_path):
+def dshelper_dict_resource_process(rd, dicname, data, res_path):
     print("dshelper_dict_resource_process %s %s %s" % (res_path, type(data), len(data)))
     if res_path.endswith('.js'):
         rd.outheaders.set('Content-Type', 'text/javascript; charset=UTF-8', replace_all=True)
         return data
     elif res_path.endswith('.css'):
         rd.outheaders.set('Content-Type', 'text/css; charset=UTF-8', replace_all=True)
-        if rd.cookies.get('textColor', '#') != '#':     #indicating dark theme
+        if rd.cookies.get('textColor', '#') != '#' and not dshelper_dict_client_theme():     #indicating dark theme
             textColor = rd.cookies["textColor"]
-            css_str = data.decode("UTF-8")
-            css_str = re.sub(r'(?!-)color\s*:[^;}]+', r'color:%s' % textColor, css_str)
-            css_str = re.sub(r'(?!-)background\s*:[^;}]+', r'background:#2F2F2F', css_str)
-            css_str = re.sub(r'(?!-)background-color\s*:[^;}]+', r'background-color:#2F2F2F', css_str)
-            
-            print("textColor css %s %s %s" % (res_path, type(data), css_str))
-            return css_str.encode('utf-8')
+            cache = css_cache()
+            cache_key = (dicname, res_path, textColor)
+            css = cache.get(cache_key)
+            if css is None:
+                css = dark_theme_css(data.decode('UTF-8', 'replace'), textColor).encode('utf-8')
+                cache.put(cache_key, css)
+                print("textColor css %s %s %d" % (res_path, textColor, len(css)))
+            return css
         else:
             return data
     else:
-        if res_path.endswith('.jpg') or res_path.endswith('.jpeg'):
-            rd.outheaders.set('Content-Type', 'image/jpeg', replace_all=True)
-        else:
-            rd.outheaders.set('Content-Type', 'image/png', replace_all=True)
+        rd.outheaders.set('Content-Type', resource_content_type(res_path, data), replace_all=True)
         print('dshelper_dict_viewer resources data from mdd %s %d' % (res_path, len(str(data))))
         #print('dshelper_dict_viewer resources data from mdd %s %s' % (res_path, str(data)))
         return data
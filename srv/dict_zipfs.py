@@ -0,0 +1,108 @@
+import mmap
+import os
+import posixpath
+import struct
+import zipfile
+import zlib
+from threading import Lock
+
+from calibre.constants import iswindows
+
+LOCAL_HEADER = struct.Struct('<4sHHHHHIIIHH')
+
+
+class ZipFS:
+
+    '''
+    Read-only view of the files of a zipped dictionary next to its mdx, so
+    stylesheets, scripts and images are served without being extracted.
+    Stored members are copied out of a memory map of the zip, deflated ones
+    are decompressed when asked for, callers cache the result of either.
+    The mdx and mdd themselves are still extracted, mdict_query opens them
+    by path and writes its index databases next to them.
+
+    The zip is only held open by the memory map, and not at all on windows,
+    where an open file cannot be replaced by calibre. calibre rewrites a
+    format in place, so every read first checks the zip is still the one
+    indexed, read() returns None once it was changed or closed.
+    '''
+
+    def __init__(self, path, prefix=''):
+        self.path = path
+        self.prefix = prefix.strip('/')
+        self.lock = Lock()
+        st = os.stat(path)
+        self.signature = (st.st_size, st.st_mtime)
+        with zipfile.ZipFile(path) as zf:
+            self.members = {}
+            for info in zf.infolist():
+                if not info.is_dir():
+                    self.members[info.filename.lower()] = info
+        self.offsets = {}
+        self.mm = None
+        self.closed = False
+
+    def __repr__(self):
+        return 'ZipFS(%r, %r)' % (self.path, self.prefix)
+
+    def find(self, req_id):
+        name = posixpath.normpath(posixpath.join(self.prefix, req_id.replace('\\', '/').lstrip('/')))
+        if name.startswith('../') or name == '..':
+            return None
+        return self.members.get(name.lower(), None)
+
+    def unchanged(self):
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return False
+        return (st.st_size, st.st_mtime) == self.signature
+
+    def read(self, info):
+        if self.closed or not self.unchanged():
+            print('ZipFS %s changed, not reading %s' % (self.path, info.filename))
+            return None
+        if info.compress_type not in (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED):
+            with zipfile.ZipFile(self.path) as zf:
+                return zf.read(info)
+
+        if iswindows:
+            with open(self.path, 'rb') as f:
+                start = self.data_offset(info, f)
+                f.seek(start)
+                data = f.read(info.compress_size)
+        else:
+            mm = self.mapped()
+            if mm is None:
+                return None
+            start = self.data_offset(info, mm)
+            data = mm[start:start + info.compress_size]
+        if info.compress_type == zipfile.ZIP_DEFLATED:
+            data = zlib.decompress(data, -zlib.MAX_WBITS)
+        if len(data) != info.file_size or zlib.crc32(data) != info.CRC:
+            raise zipfile.BadZipFile('bad member %s in %s' % (info.filename, self.path))
+        return data
+
+    def data_offset(self, info, f):
+        offset = self.offsets.get(info.filename, None)
+        if offset is None:
+            with self.lock:     # the memory map has a single position
+                f.seek(info.header_offset)
+                header = LOCAL_HEADER.unpack(f.read(LOCAL_HEADER.size))
+            offset = info.header_offset + LOCAL_HEADER.size + header[9] + header[10]
+            self.offsets[info.filename] = offset
+        return offset
+
+    def mapped(self):
+        with self.lock:
+            if self.mm is None and not self.closed:
+                with open(self.path, 'rb') as f:
+                    self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            return self.mm
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            if self.mm is not None:
+                self.mm.close()
+                self.mm = None
@@ -4,6 +4,7 @@
 
 
 import json
+import os
 from functools import partial
 from importlib import import_module
 from threading import Lock
@@ -201,6 +202,9 @@ class Handler:
             self.router.load_routes(itervalues(vars(module)))
         self.router.finalize()
         self.router.ctx.url_for = self.router.url_for
+        from calibre_plugins.dsreader_helper.srv.dict_resources import load_static_assets
+        import calibre_plugins.dsreader_helper.config as cfg
+        self.router.ctx.static_assets = load_static_assets(os.path.dirname(cfg.__file__))
         self.dispatch = self.router.dispatch
         print('Handler Plugin')
 
@@ -1,3 +1,55 @@
+function get_cookie(name) {
+    for (let cookie of document.cookie.split(';')) {
+        let pos = cookie.indexOf('=');
+        if (pos > 0 && cookie.substring(0, pos).trim() == name) {
+            return decodeURIComponent(cookie.substring(pos + 1).trim());
+        }
+    }
+    return null;
+}
+
+function apply_theme() {
+    // server output is theme independent, colours come from the reader's cookies
+    let root = document.documentElement;
+    let text_color = get_cookie('textColor');
+    let background_color = get_cookie('backgroundColor');
+    if (background_color) {
+        root.style.setProperty('--mdict-background-color', background_color);
+        root.classList.add('mdict-background');
+    }
+    if (text_color && text_color != '#') {
+        root.style.setProperty('--mdict-text-color', text_color);
+        root.classList.add('mdict-text');
+    }
+}
+
+function apply_theme_stylesheets() {
+    // same rewrite as the server used to do on dictionary css for dark theme
+    if (!document.documentElement.classList.contains('mdict-text')) {
+        return;
+    }
+    for (let sheet of document.styleSheets) {
+        let rules;
+        try {
+            rules = sheet.cssRules;
+        } catch (e) {
+            continue;
+        }
+        for (let rule of rules) {
+            if (!rule.style || (sheet.ownerNode && sheet.ownerNode.id.startsWith('style_folio'))) {
+                continue;
+            }
+            for (let i = rule.style.length - 1; i >= 0; i--) {
+                let property = rule.style[i];
+                if (property == 'background-color') {
+                    rule.style.setProperty(property, 'var(--mdict-dark-background-color, #2F2F2F)');
+                } else if (property.endsWith('color') && !property.startsWith('background')) {
+                    rule.style.setProperty(property, 'var(--mdict-text-color)');
+                }
+            }
+        }
+    }
+}
 
 function click_sound(event) {
     // prevent default action: jump by a.href
@@ -30,13 +82,26 @@ function click_entry(event) {
     window.location.href = url;
 }
 
-for (let element of document.getElementsByTagName('A')) {
-    if (element.href) {
-        let url = element.href;
-        if (element.href.startsWith('sound://')) {
-            element.addEventListener('click', click_sound);
-        } else if (element.href.startsWith('entry://')) {
-            element.addEventListener('click', click_entry);
+function bind_links() {
+    for (let element of document.getElementsByTagName('A')) {
+        if (element.href) {
+            let url = element.href;
+            if (element.href.startsWith('sound://') || element.dataset.mdictSound) {
+                element.addEventListener('click', click_sound);
+            } else if (element.href.startsWith('entry://')) {
+                element.addEventListener('click', click_entry);
+            }
         }
     }
 }
+
+if (document.documentElement.dataset.mdictTheme == 'client') {
+    apply_theme();
+    window.addEventListener('load', apply_theme_stylesheets);
+}
+
+if (document.readyState == 'loading') {
+    document.addEventListener('DOMContentLoaded', bind_links);
+} else {
+    bind_links();
+}
@@ -0,0 +1,94 @@
+import importlib.util
+import os
+import re
+import unittest
+
+# dict_resources has no calibre dependencies, load it straight from the file
+# so the tests run without calibre_plugins on the path
+_spec = importlib.util.spec_from_file_location(
+    'dict_resources', os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'srv', 'dict_resources.py'))
+dict_resources = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(dict_resources)
+
+
+class Request:
+
+    def __init__(self, inheaders):
+        self.inheaders = inheaders
+
+
+ETAG = '"abc"'
+
+# (Range, If-Range, expected) for a 10 byte resource
+RANGES = [
+    (None, None, None),
+    ('', None, None),
+    ('items=0-4', None, None),
+    ('bytes=0-4', None, (0, 5)),
+    ('bytes=3-3', None, (3, 4)),
+    ('bytes=5-', None, (5, 10)),
+    ('bytes=0-100', None, (0, 10)),
+    ('bytes= 2 - 3 ', None, (2, 4)),
+    ('bytes=-3', None, (7, 10)),
+    ('bytes=-100', None, (0, 10)),
+    ('bytes=-0', None, False),
+    ('bytes=10-', None, False),
+    ('bytes=10-20', None, False),
+    ('bytes=100-', None, False),
+    ('bytes=5-3', None, None),
+    ('bytes=-', None, None),
+    ('bytes=a-b', None, None),
+    ('bytes=+1-2', None, None),
+    ('bytes=1', None, None),
+    ('bytes=0-1,3-4', None, None),
+    ('bytes=0-4', ETAG, (0, 5)),
+    ('bytes=0-4', '"other"', None),
+]
+
+
+class ParseRangeTest(unittest.TestCase):
+
+    def test_ranges(self):
+        for header, if_range, expected in RANGES:
+            with self.subTest(range=header, if_range=if_range):
+                inheaders = {}
+                if header is not None:
+                    inheaders['Range'] = header
+                if if_range is not None:
+                    inheaders['If-Range'] = if_range
+                self.assertEqual(dict_resources.parse_range(Request(inheaders), 10, ETAG), expected)
+
+
+def old_dark_theme_css(css_str, text_color):
+    # the three passes dark_theme_css replaced
+    css_str = re.sub(r'(?!-)color\s*:[^;}]+', r'color:%s' % text_color, css_str)
+    css_str = re.sub(r'(?!-)background\s*:[^;}]+', r'background:#2F2F2F', css_str)
+    css_str = re.sub(r'(?!-)background-color\s*:[^;}]+', r'background-color:#2F2F2F', css_str)
+    return css_str
+
+
+STYLESHEETS = [
+    'body { color: black; background: white; }',
+    'p{color:#000;background-color:#fff}',
+    '.a { background: url(bg.png) no-repeat #fff; color : red }',
+    '.b { border-color: red; border-bottom-color: blue; }',
+    '.c { font-color: red; -webkit-text-fill-color: red; }',
+    '.d { background-color: rgba(0, 0, 0, 0.5); }',
+    '.e { color: red !important }\n.f { background:none }',
+    '@media (prefers-color-scheme: dark) { .g { color: white } }',
+    '/* color: red; */ .h { text-decoration-color: red }',
+    '.i{}',
+    '',
+]
+
+
+class DarkThemeCssTest(unittest.TestCase):
+
+    def test_matches_old_passes(self):
+        for css in STYLESHEETS:
+            with self.subTest(css=css):
+                self.assertEqual(dict_resources.dark_theme_css(css, '#EEEEEE'), old_dark_theme_css(css, '#EEEEEE'))
+
+
+if __name__ == '__main__':
+    unittest.main()
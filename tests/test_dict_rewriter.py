@@ -0,0 +1,139 @@
+import importlib.util
+import os
+import re
+import time
+import unittest
+from urllib.parse import quote
+
+import bs4
+
+# dict_rewriter has no calibre dependencies, load it straight from the file
+# so the tests run without calibre_plugins on the path
+_spec = importlib.util.spec_from_file_location(
+    'dict_rewriter', os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'srv', 'dict_rewriter.py'))
+dict_rewriter = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(dict_rewriter)
+
+
+def bs4_rewrite(content, dicname_quote, text_color=None):
+    # the BeautifulSoup rewriting dict_rewriter replaced
+    dict_soup = bs4.BeautifulSoup(content, 'html.parser')
+    for link in dict_soup.find_all('link'):
+        if link.has_attr('href'):
+            link['href'] = 'resources?dic=%s&id=%s' % (dicname_quote, quote(link['href']))
+    for script in dict_soup.find_all('script'):
+        if script.has_attr('src'):
+            script['src'] = 'resources?dic=%s&id=%s' % (dicname_quote, quote(script['src']))
+    for img in dict_soup.find_all('img'):
+        if img.has_attr('src'):
+            img['src'] = 'resources?dic=%s&id=%s' % (dicname_quote, quote(img['src']))
+    for a in dict_soup.find_all('a'):
+        if a.has_attr('href'):
+            a_href = a['href']
+            a_href = a_href.replace('entry://#', '#')
+            a_href = a_href.replace('entry://', 'lookup?word=')
+            a_href = re.sub(r'/+$', r'', a_href)
+            a['href'] = a_href
+    if text_color:
+        for f in dict_soup.find_all('font'):
+            if f.has_attr('color'):
+                f['color'] = text_color
+    return str(dict_soup)
+
+
+def tags(markup):
+    return [(tag.name, tag.attrs) for tag in bs4.BeautifulSoup(markup, 'html.parser').find_all(True)]
+
+
+CASES = [
+    '<link rel="stylesheet" type="text/css" href="style.css">',
+    '<link rel=stylesheet href=style.css/>',
+    '<script type="text/javascript" src="jquery.js"></script>',
+    '<script>if (a < b && c > d) { document.write("<img src=\'x.png\'>"); }</script><img src="y.png">',
+    '<style>p > b { color: red; }</style><img src="y.png">',
+    '<img src="images/a b.png" alt="a &amp; b">',
+    '<IMG SRC=\'x.png\' WIDTH=10>',
+    '<img alt=don\'t src=x.png>',
+    '<img alt=a"b src=x.png>',
+    '<img title="a>b" src="x.png">',
+    '<img src=a/b.png/>',
+    '<img\nsrc="x.png"\n/>',
+    '<img src="x.png?a=1&amp;b=2">',
+    '<a href="entry://run">run</a> <a href="entry://#sec">sec</a> <a href="entry://ran/">ran</a>',
+    '<a href=entry://go>go</a><a name="x">x</a><a href="http://example.com/">ex</a>',
+    '<font color="red">red</font><font face="serif">serif</font>',
+    '<!-- <img src="x.png"> --><img src="y.png">',
+    '<div class="a b"><span>text</span><br/><p>1 < 2</p></div>',
+    '<img src="x.png" src="y.png">',
+    '<img src>',
+    '<img src="">',
+    '<b>unterminated <img src="x.png"',
+]
+
+
+class RewriterTest(unittest.TestCase):
+
+    def assertSameAsBs4(self, content, text_color=None):
+        expected = bs4_rewrite(content, 'd%231', text_color)
+        actual = dict_rewriter.rewrite_definition(content, 'd%231', text_color)
+        self.assertEqual(tags(actual), tags(expected), content)
+
+    def test_matches_bs4(self):
+        for content in CASES:
+            with self.subTest(content=content):
+                self.assertSameAsBs4(content)
+
+    def test_matches_bs4_text_color(self):
+        for content in CASES:
+            with self.subTest(content=content):
+                self.assertSameAsBs4(content, '#123456')
+
+    def test_unquoted_value_with_quote(self):
+        out = dict_rewriter.rewrite_definition('<img alt=don\'t src=x.png>', 'd')
+        self.assertEqual(out, '<img alt=don\'t src="resources?dic=d&amp;id=x.png">')
+
+    def test_untouched_markup_is_copied(self):
+        content = '<div  class=x>a &amp; b<br>\n<!-- c --></div>'
+        self.assertEqual(dict_rewriter.rewrite_definition(content, 'd'), content)
+
+    def test_resources_and_version(self):
+        resources = []
+        out = dict_rewriter.rewrite_definition(
+            '<link href="a.css"><img src="b.png"><script src="c.js"></script>', 'd',
+            base='/dshelper/', version=3, resources=resources)
+        self.assertEqual(resources, ['a.css', 'b.png', 'c.js'])
+        self.assertIn('href="/dshelper/resources?dic=d&amp;id=a.css&amp;v=3"', out)
+
+    def test_sound(self):
+        out = dict_rewriter.rewrite_definition('<a href="sound://a.mp3">play</a>', 'd')
+        self.assertEqual(tags(out), [('a', {'data-mdict-sound': '1', 'href': 'resources?dic=d&id=a.mp3'})])
+
+    def test_inline(self):
+        def inline(tag, res_id):
+            return 'p{}' if tag == 'link' else 'data:image/png;base64,AA=='
+        out = dict_rewriter.rewrite_definition('<link rel="stylesheet" href="a.css"><img src="b.png">', 'd', inline=inline)
+        self.assertEqual(out, '<style>p{}</style><img src="data:image/png;base64,AA==">')
+
+    def test_unclosed_tag_is_fast(self):
+        content = '<a ' + 'x=y/ ' * 20000
+        self.assertEqual(dict_rewriter.rewrite_definition(content, 'd'), content)
+
+    def assertFast(self, content):
+        start = time.monotonic()
+        self.assertEqual(dict_rewriter.rewrite_definition(content, 'd'), content)
+        self.assertLess(time.monotonic() - start, 0.5)
+
+    def test_unclosed_tags_are_fast(self):
+        self.assertFast('<' + 'a<' * 1000)
+        self.assertFast('<' + 'a<' * 20000)
+
+    def test_unclosed_cjk_tags_are_fast(self):
+        self.assertFast('<p>中文' + '<b中' * 400)
+        self.assertFast('<p>中文' + '<b中' * 20000)
+
+    def test_unclosed_tags_before_last_tag_are_fast(self):
+        self.assertFast('<' + 'a<' * 20000 + '<br>')
+
+
+if __name__ == '__main__':
+    unittest.main()